@@ -0,0 +1,29 @@
+""" Micro-benchmark for the EMI hot path: the plain formula against the
+    annuity-factor table. Run with `python benchmarks/emi.py`. """
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loanapp.loanapplib.emi import calculate_emi, calculate_emi_formula
+
+NUMBER = 200000
+CASES = [(10000, 10, 3), (250000, 12, 24), (1500000, 15, 360)]
+
+
+def main():
+    for p, r, t in CASES:
+        formula = timeit.timeit(lambda: calculate_emi_formula(p, r, t), number=NUMBER)
+        table = timeit.timeit(lambda: calculate_emi(p, r, t), number=NUMBER)
+        print(
+            f"p={p:>8} r={r:>2} t={t:>3}  "
+            f"formula {formula / NUMBER * 1e9:7.1f} ns  "
+            f"table {table / NUMBER * 1e9:7.1f} ns  "
+            f"speedup {formula / table:4.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+""" Endpoint benchmark. Seeds a throwaway SQLite database, then drives the
+    API routes through the Flask test client and/or over real HTTP and
+    reports throughput, latency percentiles and SQL queries per request.
+
+    python benchmarks/endpoints.py --users 10000 --requests 300 --concurrency 8 \\
+        --mode both --output after.json --compare before.json
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_PASSWORD = "benchpass"
+
+# Items per request for the batch and bulk scenarios.
+BATCH_SIZE = 20
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class QueryCounter:
+    """ Counts SQL statements run on an engine. """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+class Pool:
+    """ Thread-safe supply of IDs that can only be used once, e.g. pending
+        applications for POST /loans/request. """
+
+    def __init__(self, items):
+        self._items = list(items)
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            return self._items.pop() if self._items else None
+
+    def take_many(self, count):
+        """ Up to 'count' items, or None once the pool is empty. """
+
+        with self._lock:
+            if not self._items:
+                return None
+            items = self._items[-count:]
+            del self._items[-count:]
+            return items
+
+    def split(self):
+        """ Move half of the items to a new pool, so two scenarios do not
+            compete for the same rows. """
+
+        with self._lock:
+            half = self._items[: len(self._items) // 2]
+            del self._items[: len(self._items) // 2]
+        return Pool(half)
+
+
+def setup_database(args):
+    """ Point the app at a fresh SQLite file, seed it and return the app
+        together with what the scenarios need. """
+
+    path = os.path.join(tempfile.mkdtemp(prefix="loanapp-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from loanapp import app, db
+    from loanapp.loans.models import Application, Loan
+    from loanapp.loans.stats import refresh_loan_stats
+    from loanapp.seed import SEED_PASSWORD, seed_database
+    from loanapp.users.models import User
+    from loanapp.users.summary import rebuild_summaries
+    from loanapp.users.views import login_limits_by_address, login_limits_by_name
+    from werkzeug.security import generate_password_hash
+
+    # The benchmark logs in far more often than any real client would.
+    for limiter in (login_limits_by_name, login_limits_by_address):
+        limiter.rate = limiter.burst = float("inf")
+
+    db.create_all()
+    boss = User("bench-admin", generate_password_hash(BENCH_PASSWORD, method="sha256"))
+    boss.setAdmin()
+    boss.setAgent()
+    db.session.add(boss)
+    db.session.commit()
+    seed_database(args.users, args.applications_per_user, args.seed)
+    rebuild_summaries()
+    refresh_loan_stats()
+
+    customer = User.query.filter(User.admin == False, User.agent == False).first()
+    context = {
+        "path": path,
+        "customer": customer.name,
+        "customer_password": SEED_PASSWORD,
+        "customer_id": customer.id,
+        "loan_id": db.session.query(db.func.max(Loan.id)).scalar() or 1,
+        "pending": Pool(
+            db.session.query(Application.id, Application.user_id).filter(Application.requested == False)
+        ),
+        "new_loans": Pool(
+            db.session.query(Loan.id, Loan.user_id).filter(Loan.loan_state == "NEW")
+        ),
+        "users": Pool(
+            db.session.query(User.id).filter(
+                User.admin == False, User.agent == False, User.id != customer.id
+            )
+        ),
+        "new_names": Pool((name,) for name in ("bench-user-" + str(i) for i in range(args.requests))),
+    }
+    context["edit_loans"] = context["new_loans"].split()
+    context["batch_loans"] = context["new_loans"].split()
+    context["batch_pending"] = context["pending"].split()
+    context["delete_users"] = context["users"].split()
+    db.session.remove()
+    return app, db, context
+
+
+def scenarios(context):
+    """ (name, function returning (method, path, json body, role) or None
+        when the scenario has run out of rows to work on). """
+
+    def fixed(method, path, body=None, role="admin"):
+        return lambda: (method, path, body, role)
+
+    def from_pool(pool, build):
+        def next_request():
+            item = pool.take()
+            return build(*item) if item is not None else None
+
+        return next_request
+
+    def from_pool_batch(pool, build):
+        def next_request():
+            items = pool.take_many(BATCH_SIZE)
+            return build(items) if items is not None else None
+
+        return next_request
+
+    return [
+        ("login", fixed("GET", "/users/login", role="login")),
+        ("get_interest_rates", fixed("GET", "/loans/get-interest-rates", {"tenure": 12}, None)),
+        ("get_loan_info", fixed("GET", "/loans/get-loan-info", {"amount": 250000, "tenure": 36}, None)),
+        (
+            "get_loan_grid",
+            fixed(
+                "GET",
+                "/loans/get-loan-grid",
+                {"amounts": list(range(10000, 510000, 10000)), "tenures": list(range(6, 366, 6))},
+                None,
+            ),
+        ),
+        ("get_users", fixed("GET", "/users")),
+        ("get_user", fixed("GET", "/users/" + str(context["customer_id"]))),
+        ("get_loans_page", fixed("GET", "/loans?limit=100")),
+        ("get_loans_new_page", fixed("GET", "/loans?limit=100&loan_state=NEW")),
+        ("get_loans_customer", fixed("GET", "/loans", role="customer")),
+        ("view_applications_pending", fixed("GET", "/loans/view-applications?requested=false&limit=100")),
+        ("view_applications_all", fixed("GET", "/loans/view-applications")),
+        ("loan_stats", fixed("GET", "/loans/stats")),
+        ("loan_projection", fixed("GET", "/loans/projection?months=120")),
+        ("loan_schedule", fixed("GET", "/loans/" + str(context["loan_id"]) + "/schedule")),
+        ("apply", fixed("POST", "/loans/apply", {"amount": 50000, "tenure": 24}, "customer")),
+        (
+            "apply_bulk",
+            fixed(
+                "POST",
+                "/loans/apply/bulk",
+                {
+                    "applications": [
+                        {"user_id": context["customer_id"], "amount": 50000, "tenure": 24}
+                    ]
+                    * BATCH_SIZE
+                },
+            ),
+        ),
+        ("claim", fixed("POST", "/loans/claim", {"count": BATCH_SIZE})),
+        (
+            "request",
+            from_pool(
+                context["pending"],
+                lambda application_id, user_id: (
+                    "POST",
+                    "/loans/request",
+                    {"application_id": application_id, "user_id": user_id},
+                    "admin",
+                ),
+            ),
+        ),
+        (
+            "request_batch",
+            from_pool_batch(
+                context["batch_pending"],
+                lambda items: (
+                    "POST",
+                    "/loans/request/batch",
+                    {
+                        "applications": [
+                            {"application_id": application_id, "user_id": user_id}
+                            for application_id, user_id in items
+                        ]
+                    },
+                    "admin",
+                ),
+            ),
+        ),
+        (
+            "edit",
+            from_pool(
+                context["edit_loans"],
+                lambda loan_id, user_id: (
+                    "PUT",
+                    "/loans/edit/" + str(loan_id),
+                    {"amount": 60000, "tenure": 36},
+                    "admin",
+                ),
+            ),
+        ),
+        (
+            "approve",
+            from_pool(
+                context["new_loans"],
+                lambda loan_id, user_id: (
+                    "PUT",
+                    "/loans/approve",
+                    {"loan_id": loan_id, "user_id": user_id},
+                    "admin",
+                ),
+            ),
+        ),
+        (
+            "approve_batch",
+            from_pool_batch(
+                context["batch_loans"],
+                lambda items: (
+                    "PUT",
+                    "/loans/approve/batch",
+                    {"loan_ids": [loan_id for loan_id, user_id in items]},
+                    "admin",
+                ),
+            ),
+        ),
+        (
+            "create_user",
+            from_pool(
+                context["new_names"],
+                lambda name: ("POST", "/users", {"name": name, "password": BENCH_PASSWORD}, None),
+            ),
+        ),
+        (
+            "promote_user",
+            from_pool(
+                context["users"],
+                lambda user_id: ("PATCH", "/users/" + str(user_id), None, "admin"),
+            ),
+        ),
+        (
+            "delete_user",
+            from_pool(
+                context["delete_users"],
+                lambda user_id: ("DELETE", "/users/" + str(user_id), None, "admin"),
+            ),
+        ),
+    ]
+
+
+def basic_auth(name, password):
+    return "Basic " + base64.b64encode((name + ":" + password).encode()).decode()
+
+
+class TestClientTransport:
+    name = "client"
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body, headers):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(
+            path,
+            method=method,
+            data=json.dumps(body) if body is not None else None,
+            content_type="application/json",
+            headers=headers,
+        )
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    name = "http"
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.base = "http://127.0.0.1:" + str(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, body, headers):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base + path, data=data, method=method, headers=headers)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def run_scenario(transport, next_request, headers_for, requests, concurrency, counter):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        planned = next_request()
+        if planned is None:
+            return
+        method, path, body, role = planned
+        started = time.perf_counter()
+        status, data = transport.request(method, path, body, headers_for(role))
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    queries_before = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    queries = counter.count - queries_before
+
+    latencies.sort()
+    done = len(latencies)
+    return {
+        "requests": done,
+        "errors": errors,
+        "throughput_rps": round(done / wall, 1) if wall else 0.0,
+        "mean_ms": round(sum(latencies) / done * 1000, 3) if done else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries_per_request": round(queries / done, 2) if done else 0.0,
+    }
+
+
+def compare(results, previous):
+    print("\nChange in p50 / throughput against the previous run:")
+    for mode, scenario_results in results.items():
+        for name, result in scenario_results.items():
+            before = previous.get("results", {}).get(mode, {}).get(name)
+            if not before or not before["p50_ms"] or not before["throughput_rps"]:
+                continue
+            p50 = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+            rps = (result["throughput_rps"] - before["throughput_rps"]) / before["throughput_rps"] * 100
+            print(f"  {mode:6} {name:28} p50 {p50:+7.1f}%  throughput {rps:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="Seeded users.")
+    parser.add_argument("--applications-per-user", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mode", choices=["client", "http", "both"], default="client")
+    parser.add_argument("--only", help="Comma separated scenario names to run.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Previous JSON results to compare with.")
+    args = parser.parse_args()
+
+    app, db, context = setup_database(args)
+    counter = QueryCounter(db.engine)
+
+    transports = []
+    if args.mode in ("client", "both"):
+        transports.append(TestClientTransport(app))
+    if args.mode in ("http", "both"):
+        transports.append(HTTPTransport(app))
+
+    selected = scenarios(context)
+    if args.only:
+        names = set(args.only.split(","))
+        selected = [(name, scenario) for name, scenario in selected if name in names]
+
+    results = {}
+    for transport in transports:
+        tokens = {}
+        for role, name, password in [
+            ("admin", "bench-admin", BENCH_PASSWORD),
+            ("customer", context["customer"], context["customer_password"]),
+        ]:
+            status, data = transport.request("GET", "/users/login", None, {"Authorization": basic_auth(name, password)})
+            tokens[role] = json.loads(data)["token"]
+
+        def headers_for(role):
+            if role == "login":
+                return {"Authorization": basic_auth("bench-admin", BENCH_PASSWORD)}
+            if role is None:
+                return {}
+            return {"x-access-token": tokens[role]}
+
+        results[transport.name] = {}
+        for name, next_request in selected:
+            result = run_scenario(
+                transport, next_request, headers_for, args.requests, args.concurrency, counter
+            )
+            results[transport.name][name] = result
+            print(
+                f"{transport.name:6} {name:28} {result['requests']:6} req "
+                f"{result['throughput_rps']:9.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+                f"p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+                f"{result['queries_per_request']:6.2f} q/req  {result['errors']} errors"
+            )
+        transport.close()
+
+    report = {
+        "config": {
+            "users": args.users,
+            "applications_per_user": args.applications_per_user,
+            "seed": args.seed,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+""" Benchmark for the cash-flow projection on synthetic approved loans.
+    Run with `python benchmarks/projection.py [loans] [workers]`. """
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loanapp.loanapplib.emi import calculate_emi_batch
+from loanapp.loanapplib.projection import project_cashflows
+
+CHUNK_SIZE = 5000
+FIRST_MONTH = 2026 * 12
+
+
+def synthetic_chunks(loans, seed=0):
+    rng = np.random.default_rng(seed)
+    for start in range(0, loans, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, loans - start)
+        principal = rng.integers(1000, 1000000, size)
+        tenure = rng.integers(1, 361, size)
+        quotes = calculate_emi_batch(principal, tenure)
+        yield {
+            "principal": principal,
+            "interest_rate": quotes["interest_rate"],
+            "tenure": tenure,
+            "emi": quotes["emi"],
+            "start_month": FIRST_MONTH - rng.integers(0, 120, size),
+        }
+
+
+def main():
+    loans = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    chunks = list(synthetic_chunks(loans))
+    started = time.perf_counter()
+    projection = project_cashflows(chunks, FIRST_MONTH, 360, workers)
+    elapsed = time.perf_counter() - started
+
+    print(f"{loans} loans x 360 months, {workers} workers: {elapsed:.2f} s")
+    print(f"first month collections: {projection[0]['total']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 from os import environ, path, makedirs
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from loanapp import commands
+from loanapp.database import DEFAULT_DATABASE_PROFILES, Database
+from loanapp.loanapplib.gir import DEFAULT_RATE_TIERS, rate_table
 
 app = Flask(__name__, instance_relative_config=True)
 
@@ -15,12 +16,77 @@ app.config.from_mapping(
     SQLALCHEMY_DATABASE_URI = environ.get('DATABASE_URL') or \
         'sqlite:///' + path.join(app.instance_path, 'data.db'),
     SQLALCHEMY_TRACK_MODIFICATIONS = False,
-    SECRET_KEY = 'dev'
+    SECRET_KEY = 'dev',
+    DATABASE_PROFILES = DEFAULT_DATABASE_PROFILES,
+    DATABASE_PROFILE = environ.get('DATABASE_PROFILE', 'balanced'),
+    # Comma separated; read only views are spread over these.
+    DATABASE_REPLICA_URLS = [
+        url for url in environ.get('DATABASE_REPLICA_URLS', '').split(',') if url
+    ],
+    REPLICA_CHECK_SECONDS = 5,
+    REPLICA_RETRY_SECONDS = 30,
+    # How long a client's reads stay on the primary after it writes.
+    REPLICA_STICKY_SECONDS = 5,
+    LOAN_GRID_MAX_CELLS = 10000,
+    PAGE_SIZE_MAX = 1000,
+    STREAM_CHUNK_SIZE = 500,
+    CLAIM_LEASE_SECONDS = 300,
+    CLAIM_ATTEMPTS = 3,
+    APPROVE_BATCH_ATTEMPTS = 3,
+    AUTH_CACHE_SIZE = 10000,
+    AUTH_CACHE_TTL = 60,
+    HASH_POOL_WORKERS = 2,
+    HASH_POOL_MAX_PENDING = 16,
+    HASH_TIMEOUT = 10,
+    # (attempts per second, burst)
+    LOGIN_RATE_PER_NAME = (0.2, 10),
+    LOGIN_RATE_PER_ADDRESS = (5, 100),
+    RATE_TIERS = DEFAULT_RATE_TIERS,
+    RATE_TIERS_FILE = environ.get('RATE_TIERS_FILE'),
+    RATE_TIERS_CHECK_SECONDS = 5,
+    # Turning it back on needs `flask refresh-loan-stats`; loan_stats is
+    # not kept up to date while it is off.
+    LOAN_STATS_MATERIALIZED = True,
+    LOAN_STATS_SHARDS = 16,
+    PROJECTION_MONTHS = 360,
+    PROJECTION_MONTHS_MAX = 1200,
+    PROJECTION_CHUNK_SIZE = 5000,
+    PROJECTION_WORKERS = 0,
+    IMPORT_CHUNK_SIZE = 1000,
+    IMPORT_MAX_ROWS = 10000,
+    METRICS_ENABLED = True,
+    # Seconds; None leaves the slow query log off.
+    SLOW_QUERY_SECONDS = float(environ['SLOW_QUERY_SECONDS']) \
+        if environ.get('SLOW_QUERY_SECONDS') else None,
+    N_PLUS_ONE_THRESHOLD = 10,
+    SLOW_QUERY_KEEP = 100,
+    SERVER_BIND = environ.get('SERVER_BIND', '0.0.0.0:5000'),
+    # 0 means one worker per CPU.
+    SERVER_WORKERS = int(environ.get('SERVER_WORKERS', 0)),
+    SERVER_THREADS = int(environ.get('SERVER_THREADS', 8)),
+    # Restart a worker after this many requests, plus up to the jitter;
+    # 0 never restarts them.
+    SERVER_MAX_REQUESTS = int(environ.get('SERVER_MAX_REQUESTS', 0)),
+    SERVER_MAX_REQUESTS_JITTER = int(environ.get('SERVER_MAX_REQUESTS_JITTER', 0)),
+    SERVER_GRACEFUL_TIMEOUT = int(environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
 )
 
-db = SQLAlchemy(app)
+rate_table.load(app.config["RATE_TIERS"])
+if app.config["RATE_TIERS_FILE"]:
+    rate_table.watch(app.config["RATE_TIERS_FILE"], app.config["RATE_TIERS_CHECK_SECONDS"])
+
+db = Database(app)
 Migrate(app, db)
 
+from loanapp import table_versions
+
+from loanapp.metrics import metrics
+from loanapp.querylog import query_log
+
+if app.config["METRICS_ENABLED"]:
+    metrics.init_app(app)
+query_log.init_app(app)
+
 from loanapp.users.views import users_blp
 from loanapp.loans.views import loans_blp
 
@@ -29,3 +95,9 @@ app.register_blueprint(loans_blp)
 
 app.cli.add_command(commands.create_admin_command)
 app.cli.add_command(commands.init_database)
+app.cli.add_command(commands.rebuild_summaries_command)
+app.cli.add_command(commands.refresh_loan_stats_command)
+app.cli.add_command(commands.project_cashflows_command)
+app.cli.add_command(commands.export_command)
+app.cli.add_command(commands.import_applications_command)
+app.cli.add_command(commands.seed_command)
@@ -0,0 +1,26 @@
+""" python -m loanapp [--bind HOST:PORT] [--workers N] [--threads N] ... """
+
+import argparse
+import logging
+
+from loanapp.server import serve
+
+
+parser = argparse.ArgumentParser(prog="python -m loanapp", description="Serve the API with pre-forked workers.")
+parser.add_argument("--bind", help="HOST:PORT to listen on.")
+parser.add_argument("--workers", type=int, help="Worker processes, one per CPU by default.")
+parser.add_argument("--threads", type=int, help="Request threads in each worker.")
+parser.add_argument("--max-requests", type=int, help="Restart a worker after this many requests.")
+parser.add_argument("--max-requests-jitter", type=int, help="Random extra requests before a restart.")
+parser.add_argument("--graceful-timeout", type=int, help="Seconds workers get to finish on stop or reload.")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(message)s")
+serve(
+    args.bind,
+    args.workers,
+    args.threads,
+    args.max_requests,
+    args.max_requests_jitter,
+    args.graceful_timeout,
+)
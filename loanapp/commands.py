@@ -1,4 +1,10 @@
 import click
+import csv
+import gzip
+import io
+import json
+import sys
+from datetime import datetime
 
 from werkzeug.security import generate_password_hash
 
@@ -35,3 +41,174 @@ def init_database():
     from loanapp import db
     db.create_all()
     click.echo("Initialized the database.")
+
+
+@click.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """ Recompute the per-user loan summaries from scratch. """
+
+    from loanapp.users.summary import rebuild_summaries
+    count = rebuild_summaries()
+    click.echo("Rebuilt summaries for " + str(count) + " users.")
+
+
+@click.command('refresh-loan-stats')
+def refresh_loan_stats_command():
+    """ Recompute the loan statistics summary from scratch. """
+
+    from loanapp.loans.stats import refresh_loan_stats
+    refresh_loan_stats()
+    click.echo("Refreshed loan statistics.")
+
+
+@click.command('project-cashflows')
+@click.option('--months', default=360, help='Number of months to project.')
+@click.option('--workers', default=0, help='Worker processes, 0 to project in this process.')
+@click.option('--chunk-size', default=5000, help='Loans read and projected at a time.')
+def project_cashflows_command(months, workers, chunk_size):
+    """ Print the projected monthly collections on approved loans as CSV. """
+
+    from datetime import datetime
+    from loanapp.loans.stats import approved_loan_chunks
+    from loanapp.loanapplib.projection import month_index, project_cashflows
+
+    projection = project_cashflows(
+        approved_loan_chunks(chunk_size), month_index(datetime.utcnow()), months, workers
+    )
+    click.echo("month,principal,interest,total")
+    for row in projection:
+        click.echo(f"{row['month']},{row['principal']},{row['interest']},{row['total']}")
+
+
+EXPORT_DATE_COLUMNS = {
+    'loans': 'request_date',
+    'applications': 'application_date',
+    'users': None,
+}
+
+
+def export_rows(table_name, since=None, until=None, chunk_size=1000):
+    """ Yield the column names of a table and then its rows, read
+        'chunk_size' at a time. Password hashes are never exported. """
+
+    from loanapp import db
+
+    table = db.metadata.tables[table_name]
+    columns = [column for column in table.columns if column.name != 'password']
+    query = db.select(columns).order_by(table.c.id)
+
+    date_column = EXPORT_DATE_COLUMNS[table_name]
+    if date_column is not None:
+        if since is not None:
+            query = query.where(table.c[date_column] >= since)
+        if until is not None:
+            query = query.where(table.c[date_column] < until)
+
+    yield [column.name for column in columns]
+
+    result = db.session.connection().execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+@click.command('export')
+@click.argument('table', type=click.Choice(sorted(EXPORT_DATE_COLUMNS)))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('--output', default='-', help='File to write to, standard output by default.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--since', type=click.DateTime(), help='Only rows dated on or after this.')
+@click.option('--until', type=click.DateTime(), help='Only rows dated before this.')
+def export_command(table, fmt, output, compress, since, until):
+    """ Stream a table to CSV or JSON lines. """
+
+    if EXPORT_DATE_COLUMNS[table] is None and (since or until):
+        raise click.UsageError(table + ' cannot be filtered by date.')
+
+    target = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    stream = gzip.GzipFile(fileobj=target, mode='wb') if compress else target
+    out = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    try:
+        rows = export_rows(table, since, until)
+        header = next(rows)
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow([_export_value(value) for value in row])
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(header, map(_export_value, row)))) + '\n')
+    finally:
+        out.flush()
+        out.detach()
+        if compress:
+            stream.close()
+        if output != '-':
+            target.close()
+
+
+def _parse_json_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # Reported as a bad row by the import.
+        return line
+
+
+@click.command('import-applications')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Guessed from the file name by default.')
+@click.option('--chunk-size', default=5000, help='Applications inserted per transaction.')
+def import_applications_command(path, fmt, chunk_size):
+    """ Import applications from a CSV or JSON lines file, optionally
+        gzipped, with user_id, amount and tenure for each application. """
+
+    from loanapp.loans.bulk import import_applications
+
+    name = path[:-3] if path.endswith('.gz') else path
+    fmt = fmt or ('jsonl' if name.endswith(('.jsonl', '.json')) else 'csv')
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (_parse_json_line(line) for line in f if line.strip())
+        inserted, errors = import_applications(rows, chunk_size)
+
+    for error in errors:
+        click.echo('Row ' + str(error['row']) + ': ' + error['message'], err=True)
+    click.echo('Imported ' + str(inserted) + ' applications, ' + str(len(errors)) + ' rows rejected.')
+
+
+@click.command('seed')
+@click.option('--users', default=1000, help='Number of users to add.')
+@click.option('--applications-per-user', default=3.0, help='Average applications per user.')
+@click.option('--seed', 'seed_value', default=0, help='Random seed; the same seed gives the same data.')
+@click.option('--chunk-size', default=5000, help='Users written per transaction.')
+@click.option('--anchor', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Date the generated history ends at, 2026-01-01 by default.')
+def seed_command(users, applications_per_user, seed_value, chunk_size, anchor):
+    """ Fill the database with synthetic users, applications and loans. """
+
+    from loanapp.seed import SEED_ANCHOR, SEED_PASSWORD, seed_database
+    from loanapp.users.summary import rebuild_summaries
+    from loanapp.loans.stats import refresh_loan_stats
+
+    users, applications, loans = seed_database(
+        users, applications_per_user, seed_value, chunk_size, anchor or SEED_ANCHOR
+    )
+    rebuild_summaries()
+    refresh_loan_stats()
+    click.echo(
+        'Added ' + str(users) + ' users, ' + str(applications) + ' applications and '
+        + str(loans) + ' loans. Every seeded user has the password ' + SEED_PASSWORD + '.'
+    )
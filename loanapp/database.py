@@ -0,0 +1,279 @@
+from threading import Lock
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# Set after a successful write; until the time it holds the client's reads
+# go to the primary, so they see their own writes despite replica lag.
+PRIMARY_COOKIE = "primary_until"
+
+
+# Named database tuning profiles, picked with DATABASE_PROFILE.
+#
+# 'sqlite' holds the PRAGMAs run on every new SQLite connection and
+# 'sqlite_pool' the pool for a SQLite file; without one each checkout opens
+# the file again and loses its page cache. 'pool' is used for server
+# databases such as PostgreSQL and MySQL. Options set explicitly in
+# SQLALCHEMY_ENGINE_OPTIONS win over the profile.
+DEFAULT_DATABASE_PROFILES = {
+    # What SQLAlchemy does on its own: rollback journal, a new SQLite
+    # connection per checkout.
+    "none": {},
+    # WAL lets readers carry on while a write is in progress; NORMAL
+    # still survives an application crash, only a power cut can lose the
+    # latest transactions.
+    "balanced": {
+        "sqlite": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "mmap_size": 64 * 1024 * 1024,
+            # Negative means KiB rather than pages.
+            "cache_size": -16000,
+        },
+        "sqlite_pool": {"pool_size": 5, "max_overflow": 10},
+        "pool": {
+            "pool_size": 5,
+            "max_overflow": 10,
+            "pool_recycle": 1800,
+            "pool_pre_ping": True,
+            "pool_timeout": 30,
+        },
+    },
+    "throughput": {
+        "sqlite": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 10000,
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -65536,
+            "temp_store": "MEMORY",
+        },
+        "sqlite_pool": {"pool_size": 16, "max_overflow": 16},
+        "pool": {
+            "pool_size": 20,
+            "max_overflow": 20,
+            "pool_recycle": 1800,
+            "pool_pre_ping": True,
+            "pool_timeout": 10,
+        },
+    },
+    # Every commit reaches the disk before it returns.
+    "durable": {
+        "sqlite": {
+            "journal_mode": "WAL",
+            "synchronous": "FULL",
+            "busy_timeout": 5000,
+        },
+        "sqlite_pool": {"pool_size": 5, "max_overflow": 10},
+        "pool": {
+            "pool_size": 5,
+            "max_overflow": 10,
+            "pool_recycle": 1800,
+            "pool_pre_ping": True,
+        },
+    },
+}
+
+
+def read_only(f):
+    """ Mark a view as safe to serve from a read replica. Must be the
+        decorator right below the route. """
+
+    f.read_only = True
+    return f
+
+
+class _Replica:
+
+    def __init__(self, engine, probe_table):
+        self.engine = engine
+        self.probe_table = probe_table
+        self.up = True
+        self.next_check = 0
+
+    def healthy(self, now, check_seconds, retry_seconds):
+        if now >= self.next_check:
+            try:
+                # An empty or missing SQLite file still accepts 'SELECT 1'.
+                self.up = bool(self.engine.has_table(self.probe_table))
+            except Exception:
+                self.up = False
+            self.next_check = now + (check_seconds if self.up else retry_seconds)
+        return self.up
+
+    def mark_down(self, retry_seconds):
+        self.up = False
+        self.next_check = time.time() + retry_seconds
+
+
+class ReplicaSet:
+    """ Engines for DATABASE_REPLICA_URLS, handed out round-robin. A replica
+        is probed every REPLICA_CHECK_SECONDS; one that fails the probe or a
+        connection is skipped for REPLICA_RETRY_SECONDS. """
+
+    def __init__(self, db):
+        self.db = db
+        self._uris = ()
+        self._replicas = []
+        self._next = 0
+        self._lock = Lock()
+
+    def replicas(self, app):
+        uris = tuple(app.config["DATABASE_REPLICA_URLS"])
+        if uris != self._uris:
+            with self._lock:
+                if uris != self._uris:
+                    self.dispose()
+                    self._replicas = [self._connect(app, uri) for uri in uris]
+                    self._uris = uris
+        return self._replicas
+
+    def _connect(self, app, uri):
+        options = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        sa_url = make_url(uri)
+        self.db.apply_driver_hacks(app, sa_url, options)
+        engine = self.db.create_engine(sa_url, options)
+        replica = _Replica(engine, next(iter(self.db.metadata.tables), "sqlite_master"))
+        retry_seconds = app.config["REPLICA_RETRY_SECONDS"]
+
+        @event.listens_for(engine, "handle_error")
+        def connection_failed(context):
+            if context.is_disconnect or isinstance(
+                context.original_exception, engine.dialect.dbapi.OperationalError
+            ):
+                replica.mark_down(retry_seconds)
+
+        return replica
+
+    def pick(self, app):
+        """ Next healthy replica engine, or None to use the primary. """
+
+        replicas = self.replicas(app)
+        if not replicas:
+            return None
+        with self._lock:
+            start = self._next
+            self._next = (start + 1) % len(replicas)
+        now = time.time()
+        for i in range(len(replicas)):
+            replica = replicas[(start + i) % len(replicas)]
+            if replica.healthy(now, app.config["REPLICA_CHECK_SECONDS"], app.config["REPLICA_RETRY_SECONDS"]):
+                return replica.engine
+        return None
+
+    def dispose(self):
+        for replica in self._replicas:
+            replica.engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    """ Sends the queries of read_only views to a replica. Flushes, and so
+        every write, always go to the primary. """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get("use_replica"):
+            # One replica per request, so its queries see the same data.
+            if "replica" not in g:
+                g.replica = self.db.replicas.pick(self.app)
+            if g.replica is not None:
+                return g.replica
+        return super().get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """ SQLAlchemy with the engine tuned by the DATABASE_PROFILE profile and
+        reads of read_only views spread over DATABASE_REPLICA_URLS. """
+
+    def __init__(self, *args, **kwargs):
+        self.replicas = ReplicaSet(self)
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.before_request(self._route_request)
+        app.after_request(self._remember_write)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def dispose(self):
+        """ Close the pooled connections of the primary and the replicas,
+            e.g. after a fork. """
+
+        self.engine.dispose()
+        self.replicas.dispose()
+
+    def _route_request(self):
+        g.use_replica = False
+        g.pop("replica", None)
+        if request.method not in ("GET", "HEAD") or not current_app.config["DATABASE_REPLICA_URLS"]:
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if not getattr(view, "read_only", False):
+            return
+        try:
+            primary_until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        g.use_replica = primary_until < time.time()
+
+    def _remember_write(self, response):
+        if (
+            request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400
+            and current_app.config["DATABASE_REPLICA_URLS"]
+        ):
+            sticky = current_app.config["REPLICA_STICKY_SECONDS"]
+            response.set_cookie(
+                PRIMARY_COOKIE, "%.3f" % (time.time() + sticky), max_age=sticky, httponly=True
+            )
+        return response
+
+    def profile(self, app):
+        name = app.config["DATABASE_PROFILE"]
+        try:
+            return app.config["DATABASE_PROFILES"][name]
+        except KeyError:
+            raise ValueError("Unknown database profile: %s" % name)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        profile = self.profile(app)
+        if sa_url.drivername.startswith("sqlite"):
+            in_memory = sa_url.database in (None, "", ":memory:")
+            if not in_memory and profile.get("sqlite_pool"):
+                for key, value in profile["sqlite_pool"].items():
+                    options.setdefault(key, value)
+                options.setdefault("poolclass", QueuePool)
+                # Pooled connections move between threads, one at a time.
+                connect_args = dict(options.get("connect_args", {}))
+                connect_args.setdefault("check_same_thread", False)
+                options["connect_args"] = connect_args
+        else:
+            for key, value in profile.get("pool", {}).items():
+                options.setdefault(key, value)
+        super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        pragmas = self.profile(self.get_app()).get("sqlite")
+        if engine.dialect.name == "sqlite" and pragmas:
+            statements = ["PRAGMA %s = %s" % item for item in pragmas.items()]
+
+            @event.listens_for(engine, "connect")
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.close()
+
+        return engine
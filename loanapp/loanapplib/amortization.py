@@ -0,0 +1,44 @@
+import calendar
+
+from loanapp.loanapplib.emi import calculate_emi
+
+
+def _add_months(date, months):
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+def amortization_schedule(principal, interest_rate, tenure, emi=None, start_date=None):
+    """ Yield the repayment schedule one month at a time. Each row has the
+        payment split into principal and interest and the balance left after
+        it. The last payment clears whatever rounding left on the balance.
+        Rows get a 'due_date' when the loan's start date is given. """
+
+    r = interest_rate / (12 * 100)
+    if emi is None:
+        emi = calculate_emi(principal, interest_rate, tenure)
+
+    balance = principal
+    for month in range(1, tenure + 1):
+        interest = round(balance * r, 2)
+        if month == tenure:
+            principal_paid = round(balance, 2)
+            payment = round(principal_paid + interest, 2)
+        else:
+            principal_paid = round(emi - interest, 2)
+            payment = emi
+        balance = round(balance - principal_paid, 2)
+
+        row = {
+            "month": month,
+            "payment": payment,
+            "principal": principal_paid,
+            "interest": interest,
+            "balance": balance,
+        }
+        if start_date is not None:
+            row["due_date"] = _add_months(start_date, month).date().isoformat()
+        yield row
@@ -0,0 +1,41 @@
+""" Precomputed annuity factors for the EMI formula.
+
+    For a monthly rate r and tenure t the EMI is p * r * (1 + r)^t / ((1 + r)^t - 1).
+    The table keeps r, (1 + r)^t and (1 + r)^t - 1 for every rate the app
+    quotes at and every tenure up to MAX_TENURE, so no pow() is needed on the
+    request path. The factors are computed with exactly the same expressions
+    as calculate_emi, which keeps results identical to the bit. """
+
+MAX_TENURE = 360
+RATES = (10, 12, 15)
+
+_table = {}
+
+
+def _build_row(rate, max_tenure):
+    r = rate / (12 * 100)
+    row = [None]
+    for t in range(1, max_tenure + 1):
+        factor = pow(1 + r, t)
+        row.append((r, factor, factor - 1))
+    return row
+
+
+def add_rate(rate, max_tenure=MAX_TENURE):
+    """ Precompute the factors for another yearly interest rate. """
+
+    _table[rate] = _build_row(rate, max_tenure)
+
+
+def annuity_factors(rate, tenure):
+    """ Return (monthly rate, (1 + r)^t, (1 + r)^t - 1) for the yearly rate
+        and tenure, or None if they are not in the table. """
+
+    row = _table.get(rate)
+    if row is None or type(tenure) is not int or not 0 < tenure < len(row):
+        return None
+    return row[tenure]
+
+
+for _rate in RATES:
+    add_rate(_rate)
@@ -1,5 +1,87 @@
-def calculate_emi(p, r, t): 
+import numpy as np
+from loanapp.loanapplib.annuity import annuity_factors
+from loanapp.loanapplib.gir import get_interest_rate, get_interest_rates
+
+
+def calculate_emi(p, r, t):
+    factors = annuity_factors(r, t)
+    if factors is None:
+        return calculate_emi_formula(p, r, t)
+    r, factor, factor_minus_one = factors
+    return round((p * r * factor) / factor_minus_one, 2)
+
+
+def calculate_emi_formula(p, r, t): 
     r = r / (12 * 100) # one month interest
     t = t # one month period 
     emi = (p * r * pow(1 + r, t)) / (pow(1 + r, t) - 1) 
     return round(emi, 2)
+
+
+def loan_quote(principal, tenure):
+    """ Interest rate, EMI, total and interest for a single loan. """
+
+    interest_rate = get_interest_rate(tenure, principal)
+    emi = calculate_emi(principal, interest_rate, tenure)
+    total = round(emi * tenure, 2)
+    interest = round(total - principal, 2)
+    return interest_rate, emi, total, interest
+
+
+def _round(values, ndigits=2):
+    """ Round an array exactly like the builtin round() does. """
+
+    scaled = values * 10 ** ndigits
+    rounded = np.round(values, ndigits)
+    # np.round scales, rounds and scales back, so values lying right next to
+    # a rounding boundary can land on the other neighbour. Those are rare;
+    # redo them with the builtin.
+    distance = np.abs(scaled - np.floor(scaled) - 0.5)
+    near_tie = distance <= np.abs(scaled) * 1e-15 + 1e-9
+    if near_tie.any():
+        rounded[near_tie] = [round(v, ndigits) for v in values[near_tie].tolist()]
+    return rounded
+
+
+def _factor(rate, tenure):
+    factors = annuity_factors(rate, tenure)
+    if factors is None:
+        return pow(1 + rate / (12 * 100), tenure)
+    return factors[1]
+
+
+def _quotes(p, t):
+    interest_rates = get_interest_rates(t, p)
+    r = interest_rates / (12 * 100)
+    # Factors come from the annuity table (or the builtin pow past its end)
+    # so they match calculate_emi to the last bit.
+    rates, tenures = np.broadcast_arrays(interest_rates, t)
+    factor = np.array(
+        [_factor(rate, tenure) for rate, tenure in zip(rates.ravel().tolist(), tenures.ravel().tolist())]
+    ).reshape(rates.shape)
+
+    emi = _round((p * r * factor) / (factor - 1))
+    total = _round(emi * t)
+    interest = _round(total - p)
+
+    return {
+        "interest_rate": interest_rates,
+        "emi": emi,
+        "total": total,
+        "interest": interest,
+    }
+
+
+def calculate_emi_grid(amounts, tenures):
+    """ Quote every (amount, tenure) pair in one pass. Amounts run along the
+        rows and tenures along the columns of the returned arrays; every cell
+        is identical to what loan_quote returns for that pair. """
+
+    return _quotes(np.asarray(amounts, dtype=float)[:, None], np.asarray(tenures, dtype=int))
+
+
+def calculate_emi_batch(amounts, tenures):
+    """ Quote amounts[i] over tenures[i] for every i in one pass. Each element
+        is identical to what loan_quote returns for that pair. """
+
+    return _quotes(np.asarray(amounts, dtype=float), np.asarray(tenures, dtype=int))
@@ -1,7 +1,152 @@
-def get_interest_rate(tenure):
-    if int(tenure) <= 5:
-        return 10
-    elif int(tenure) > 5 and int(tenure) <= 24:
-        return 12
-    else:
-        return 15
+from bisect import bisect_left
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from loanapp.loanapplib.annuity import add_rate, annuity_factors
+
+logger = logging.getLogger(__name__)
+
+INFINITY = float("inf")
+
+# Each tier gives the yearly interest rate for loans up to 'max_tenure'
+# months and, optionally, up to 'max_amount'. None means no upper bound;
+# every tenure band must have a tier without 'max_amount' and there must be
+# a band without 'max_tenure'.
+DEFAULT_RATE_TIERS = [
+    {"max_tenure": 5, "rate": 10},
+    {"max_tenure": 24, "rate": 12},
+    {"max_tenure": None, "rate": 15},
+]
+
+
+class _Tiers:
+    """ Sorted bounds and rates of a set of tiers, ready for bisecting. """
+
+    def __init__(self, tiers):
+        bands = {}
+        for tier in tiers:
+            max_tenure = tier.get("max_tenure")
+            max_amount = tier.get("max_amount")
+            bands.setdefault(INFINITY if max_tenure is None else max_tenure, []).append(
+                (INFINITY if max_amount is None else max_amount, tier["rate"])
+            )
+        if INFINITY not in bands:
+            raise ValueError("Rate tiers need a band without 'max_tenure'.")
+
+        self.tenure_bounds = sorted(bands)
+        self.amount_bounds = []
+        self.rates = []
+        for max_tenure in self.tenure_bounds:
+            band = sorted(bands[max_tenure])
+            if band[-1][0] != INFINITY:
+                raise ValueError("Every tenure band needs a tier without 'max_amount'.")
+            self.amount_bounds.append([max_amount for max_amount, rate in band])
+            self.rates.append([rate for max_amount, rate in band])
+
+        # The same lookup as a matrix over all amount bounds, for arrays.
+        self.all_amount_bounds = sorted(
+            {bound for bounds in self.amount_bounds for bound in bounds}
+        )
+        self.rate_matrix = np.array(
+            [
+                [rates[bisect_left(bounds, bound)] for bound in self.all_amount_bounds]
+                for bounds, rates in zip(self.amount_bounds, self.rates)
+            ]
+        )
+        self.has_amount_bands = len(self.all_amount_bounds) > 1
+
+
+class RateTable:
+    """ Interest rate tiers with a bisect based lookup. The tiers can come
+        from a JSON file, which is re-read when it changes so pricing can be
+        updated without restarting the workers. """
+
+    def __init__(self, tiers=DEFAULT_RATE_TIERS):
+        self._tiers = None
+        self._path = None
+        self._mtime = None
+        self._check_interval = None
+        self._next_check = 0
+        self.load(tiers)
+
+    def load(self, tiers):
+        """ Replace the tiers. Lookups in progress keep using the old ones. """
+
+        new_tiers = _Tiers(tiers)
+        for rates in new_tiers.rates:
+            for rate in rates:
+                if annuity_factors(rate, 1) is None:
+                    add_rate(rate)
+        self._tiers = new_tiers
+
+    def watch(self, path, check_interval):
+        """ Load the tiers from a JSON file and reload them whenever the file
+            changes, checking at most every 'check_interval' seconds. """
+
+        self._path = path
+        self._check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0
+        self._reload()
+
+    def lookup(self, tenure, amount=None):
+        """ Rate for a tenure in months and, if the tiers depend on it, an
+            amount. Without an amount the lowest amount band is used. """
+
+        if self._path is not None:
+            self._reload()
+        tiers = self._tiers
+        i = bisect_left(tiers.tenure_bounds, tenure)
+        if amount is None:
+            return tiers.rates[i][0]
+        return tiers.rates[i][bisect_left(tiers.amount_bounds[i], amount)]
+
+    def lookup_array(self, tenures, amounts=None):
+        """ lookup() for arrays. The result has the broadcast shape of
+            'tenures' and 'amounts'. """
+
+        if self._path is not None:
+            self._reload()
+        tiers = self._tiers
+        i = np.searchsorted(tiers.tenure_bounds, tenures, side="left")
+        if amounts is None or not tiers.has_amount_bands:
+            j = np.zeros_like(i)
+        else:
+            j = np.searchsorted(tiers.all_amount_bounds, amounts, side="left")
+        return tiers.rate_matrix[i, j]
+
+    def _reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self._check_interval
+
+        try:
+            mtime = os.stat(self._path).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self._path) as f:
+                self.load(json.load(f))
+            self._mtime = mtime
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception("Could not load rate tiers from %s", self._path)
+
+
+rate_table = RateTable()
+
+
+def get_interest_rate(tenure, amount=None):
+    return rate_table.lookup(int(tenure), amount)
+
+
+def get_interest_rates(tenures, amounts=None):
+    """ Array version of get_interest_rate. """
+
+    tenures = np.asarray(tenures, dtype=int)
+    if amounts is not None:
+        amounts = np.asarray(amounts)
+    return rate_table.lookup_array(tenures, amounts)
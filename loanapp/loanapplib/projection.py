@@ -0,0 +1,122 @@
+""" Projected monthly collections of a portfolio of loans.
+
+    Loans come in chunks of columns (NumPy arrays) and each chunk is
+    amortized as a whole: row i of the working matrices is loan i and column
+    k its k-th payment. The per-loan schedules are then folded into calendar
+    months with np.bincount, so only the monthly totals ever leave a chunk.
+    Chunks can be spread over a process pool. """
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def month_index(date):
+    """ Months since year 0 of a date, for lining up schedules. """
+
+    return date.year * 12 + date.month - 1
+
+
+def month_label(index):
+    return "%04d-%02d" % (index // 12, index % 12 + 1)
+
+
+def project_chunk(principal, interest_rate, tenure, emi, first_month, horizon):
+    """ Principal and interest collected in each of the next 'horizon'
+        months from one chunk of loans. 'first_month' is the offset of each
+        loan's first payment from the first projected month; payments before
+        it are already in the past and left out. """
+
+    principal = np.asarray(principal, dtype=float)
+    tenure = np.asarray(tenure, dtype=int)
+    emi = np.asarray(emi, dtype=float)
+    first_month = np.asarray(first_month, dtype=int)
+    r = np.asarray(interest_rate, dtype=float) / (12 * 100)
+
+    collected_principal = np.zeros(horizon)
+    collected_interest = np.zeros(horizon)
+    if len(principal) == 0:
+        return collected_principal, collected_interest
+
+    # Balance before the k-th payment (k counted from 0), in closed form.
+    k = np.arange(tenure.max())
+    growth = (1 + r)[:, None] ** k
+    with np.errstate(divide="ignore", invalid="ignore"):
+        paid_off = np.where(
+            r[:, None] > 0, emi[:, None] * (growth - 1) / r[:, None], emi[:, None] * k
+        )
+    balance = principal[:, None] * growth - paid_off
+
+    interest = balance * r[:, None]
+    repaid = emi[:, None] - interest
+    # The last payment clears whatever is left.
+    last = k == (tenure - 1)[:, None]
+    repaid = np.where(last, balance, repaid)
+
+    month = first_month[:, None] + k
+    keep = (k < tenure[:, None]) & (month >= 0) & (month < horizon)
+    month = month[keep]
+    collected_principal += np.bincount(month, weights=repaid[keep], minlength=horizon)
+    collected_interest += np.bincount(month, weights=interest[keep], minlength=horizon)
+    return collected_principal, collected_interest
+
+
+def _project(args):
+    return project_chunk(*args)
+
+
+def project_cashflows(chunks, first_month, horizon, workers=0):
+    """ Projected collections of every loan in 'chunks' over 'horizon'
+        months starting at month_index 'first_month'. Each chunk is a dict
+        of arrays: principal, interest_rate, tenure, emi and start_month
+        (the month_index of the loan's start; payments begin the month
+        after). With 'workers' > 0 chunks are projected on a process pool.
+        Returns a list of {month, principal, interest, total}. """
+
+    collected_principal = np.zeros(horizon)
+    collected_interest = np.zeros(horizon)
+
+    jobs = (
+        (
+            chunk["principal"],
+            chunk["interest_rate"],
+            chunk["tenure"],
+            chunk["emi"],
+            np.asarray(chunk["start_month"]) + 1 - first_month,
+            horizon,
+        )
+        for chunk in chunks
+    )
+
+    if workers:
+        with ProcessPoolExecutor(workers) as executor:
+            # Keep a few chunks in flight per worker rather than reading
+            # every chunk up front.
+            pending = []
+            for job in jobs:
+                pending.append(executor.submit(_project, job))
+                if len(pending) >= workers * 2:
+                    principal, interest = pending.pop(0).result()
+                    collected_principal += principal
+                    collected_interest += interest
+            for future in pending:
+                principal, interest = future.result()
+                collected_principal += principal
+                collected_interest += interest
+    else:
+        for job in jobs:
+            principal, interest = _project(job)
+            collected_principal += principal
+            collected_interest += interest
+
+    return [
+        {
+            "month": month_label(first_month + i),
+            "principal": round(principal, 2),
+            "interest": round(interest, 2),
+            "total": round(principal + interest, 2),
+        }
+        for i, (principal, interest) in enumerate(
+            zip(collected_principal.tolist(), collected_interest.tolist())
+        )
+    ]
@@ -0,0 +1,75 @@
+from itertools import islice
+
+from loanapp import db
+from loanapp.loans.models import Application
+from loanapp.users.models import User
+from loanapp.users.summary import update_summaries
+
+
+def _validate(row):
+    """ (user_id, amount, tenure) of an application row, or raise
+        ValueError with what is wrong with it. """
+
+    if not isinstance(row, dict):
+        raise ValueError("Not an application.")
+
+    try:
+        user_id = int(row["user_id"])
+        amount = int(row["amount"])
+        tenure = int(row["tenure"])
+    except KeyError as e:
+        raise ValueError("Missing '" + e.args[0] + "'.")
+    except (TypeError, ValueError):
+        raise ValueError("'user_id', 'amount' and 'tenure' must be integers.")
+
+    if amount <= 0 or tenure <= 0:
+        raise ValueError("'amount' and 'tenure' must be positive.")
+    return user_id, amount, tenure
+
+
+def import_applications(rows, chunk_size):
+    """ Validate and insert application rows (dicts with user_id, amount
+        and tenure), 'chunk_size' at a time with one executemany and one
+        commit per chunk. Bad rows are skipped and reported as
+        {row, message} with 1-based row numbers; the rest still go in.
+        Returns (number of applications inserted, errors). """
+
+    inserted = 0
+    errors = []
+    rows = enumerate(rows, 1)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        valid = []
+        for number, row in chunk:
+            try:
+                valid.append((number,) + _validate(row))
+            except ValueError as e:
+                errors.append({"row": number, "message": str(e)})
+
+        user_ids = {user_id for number, user_id, amount, tenure in valid}
+        known_users = {
+            user_id for (user_id,) in db.session.query(User.id).filter(User.id.in_(user_ids))
+        }
+
+        mappings = []
+        pending_by_user = {}
+        for number, user_id, amount, tenure in valid:
+            if user_id not in known_users:
+                errors.append({"row": number, "message": "User does not exist."})
+                continue
+            mappings.append({"user_id": user_id, "amount": amount, "tenure": tenure})
+            pending = pending_by_user.setdefault(user_id, {"pending_applications": 0})
+            pending["pending_applications"] += 1
+
+        if mappings:
+            db.session.execute(Application.__table__.insert(), mappings)
+            update_summaries(pending_by_user)
+            db.session.commit()
+            inserted += len(mappings)
+
+    errors.sort(key=lambda error: error["row"])
+    return inserted, errors
@@ -1,9 +1,21 @@
 from loanapp import db
-from datetime import datetime
+from datetime import datetime, timezone
+
+
+def as_utc(value):
+    """ A datetime as naive UTC, the way the app writes them. Backends that
+        keep the time zone, such as PostgreSQL, read them back aware. """
+
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
 class Loan(db.Model):
 
     __tablename__ = "loans"
+    __table_args__ = (
+        db.Index("ix_loans_user_id_loan_state", "user_id", "loan_state"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(30), db.ForeignKey('users.id'))
@@ -11,11 +23,13 @@ class Loan(db.Model):
     principal = db.Column(db.Integer)
     tenure = db.Column(db.Integer)
     interest = db.Column(db.Integer)
-    interest_rate = db.Column(db.Integer)
+    # Rate tiers may have fractional rates.
+    interest_rate = db.Column(db.Float)
     emi = db.Column(db.Integer)
     total = db.Column(db.Integer)
     request_date = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
     start_date = db.Column(db.DateTime(timezone=True), default=None)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     def __init__(self, principal, tenure, interest, interest_rate, emi, total, user_id):
         self.principal = principal
@@ -38,6 +52,9 @@ class Loan(db.Model):
 class Application(db.Model):
 
     __tablename__ = "applications"
+    __table_args__ = (
+        db.Index("ix_applications_requested_application_date", "requested", "application_date"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -45,11 +62,49 @@ class Application(db.Model):
     tenure = db.Column(db.Integer)
     requested = db.Column(db.Boolean, default=False)
     application_date = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+    claimed_by = db.Column(db.Integer, db.ForeignKey('users.id'), default=None)
+    claim_expires = db.Column(db.DateTime(timezone=True), default=None)
+    # Set by each /loans/claim call, to find the rows that call claimed.
+    claim_token = db.Column(db.String(32), default=None)
 
     def __init__(self, user_id, amount, tenure):
         self.user_id = user_id
         self.amount = amount
         self.tenure = tenure
 
+    def isClaimedByOther(self, user_id):
+        return (
+            self.claimed_by is not None
+            and self.claimed_by != user_id
+            and self.claim_expires is not None
+            and as_utc(self.claim_expires) > datetime.utcnow()
+        )
+
     def __repr__(self):
         return f"Application {self.id}, userid: {self.user_id}, amount: {self.amount}"
+
+
+class LoanStat(db.Model):
+    """ Loan count and amounts for one combination of state, tenure bucket,
+        interest rate and start month, kept up to date by the loan views.
+        Loans that have not started have an empty start month. A group's
+        totals are split over several shard rows and add up to their sum. """
+
+    __tablename__ = "loan_stats"
+    __table_args__ = (
+        db.UniqueConstraint("loan_state", "tenure_bucket", "interest_rate", "start_month", "shard"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    loan_state = db.Column(db.String(10), nullable=False)
+    tenure_bucket = db.Column(db.String(10), nullable=False)
+    interest_rate = db.Column(db.Float, nullable=False)
+    start_month = db.Column(db.String(7), nullable=False)
+    shard = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    loan_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    principal = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    total = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    interest = db.Column(db.Float, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return f"LoanStat {self.loan_state}, {self.tenure_bucket}, {self.interest_rate}, {self.start_month}"
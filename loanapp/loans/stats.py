@@ -0,0 +1,273 @@
+from collections import namedtuple
+import random
+
+import numpy as np
+from sqlalchemy import case, func, insert, literal, select
+from sqlalchemy.exc import IntegrityError
+
+from loanapp import app, db
+from loanapp.loans.models import Loan, LoanStat
+from loanapp.loanapplib.projection import month_index
+
+# (upper bound in months, label); None means no upper bound.
+TENURE_BUCKETS = [(6, "1-6"), (12, "7-12"), (24, "13-24"), (60, "25-60"), (None, "61+")]
+
+DIMENSIONS = {
+    "by_state": "loan_state",
+    "by_tenure": "tenure_bucket",
+    "by_interest_rate": "interest_rate",
+    "by_start_month": "start_month",
+}
+
+# What the loan_stats table needs to know about a loan.
+LoanFacts = namedtuple(
+    "LoanFacts",
+    ["loan_state", "tenure", "interest_rate", "start_date", "principal", "total", "interest"],
+)
+
+
+def loan_facts(loan, **changes):
+    """ LoanFacts of a Loan, a row with the same attributes or a dict of
+        Loan columns, with 'changes' applied. """
+
+    if isinstance(loan, dict):
+        values = dict(loan, **changes)
+        return LoanFacts(*(values.get(field) for field in LoanFacts._fields))
+    return LoanFacts(*(changes.get(field, getattr(loan, field)) for field in LoanFacts._fields))
+
+
+def tenure_bucket(tenure):
+    for bound, label in TENURE_BUCKETS:
+        if bound is None or tenure <= bound:
+            return label
+
+
+def start_month(start_date):
+    return start_date.strftime("%Y-%m") if start_date is not None else ""
+
+
+def _tenure_bucket_sql(tenure):
+    return case(
+        [(tenure <= bound, label) for bound, label in TENURE_BUCKETS if bound is not None],
+        else_=TENURE_BUCKETS[-1][1],
+    )
+
+
+def _start_month_sql(start_date):
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        month = func.strftime("%Y-%m", start_date)
+    elif dialect == "postgresql":
+        month = func.to_char(start_date, "YYYY-MM")
+    else:
+        month = func.date_format(start_date, "%Y-%m")
+    return func.coalesce(month, literal(""))
+
+
+def record_loan_changes(removed=(), added=()):
+    """ Update loan_stats in the current transaction for loans that stopped
+        looking like 'removed' and now look like 'added' (both LoanFacts).
+        Does nothing while LOAN_STATS_MATERIALIZED is off.
+
+        Each group is spread over LOAN_STATS_SHARDS rows and a transaction
+        updates one of them, picked at random, so concurrent loan writes
+        seldom wait on each other's row locks. """
+
+    if not app.config["LOAN_STATS_MATERIALIZED"]:
+        return
+
+    deltas = {}
+    for facts, sign in [(facts, -1) for facts in removed] + [(facts, 1) for facts in added]:
+        key = (
+            facts.loan_state,
+            tenure_bucket(int(facts.tenure)),
+            float(facts.interest_rate),
+            start_month(facts.start_date),
+        )
+        delta = deltas.setdefault(key, [0, 0, 0, 0])
+        delta[0] += sign
+        delta[1] += sign * float(facts.principal)
+        delta[2] += sign * float(facts.total)
+        delta[3] += sign * float(facts.interest)
+
+    shard = random.randrange(app.config["LOAN_STATS_SHARDS"])
+    # Always lock rows in the same order, so two transactions cannot
+    # deadlock on them.
+    for key, (count, principal, total, interest) in sorted(deltas.items()):
+        if count == 0 and principal == 0 and total == 0 and interest == 0:
+            continue
+        _apply(key, shard, count, principal, total, interest)
+
+
+def _apply(key, shard, count, principal, total, interest):
+    loan_state, bucket, interest_rate, month = key
+    row = LoanStat.query.filter_by(
+        loan_state=loan_state,
+        tenure_bucket=bucket,
+        interest_rate=interest_rate,
+        start_month=month,
+        shard=shard,
+    )
+    values = {
+        "loan_count": LoanStat.loan_count + count,
+        "principal": LoanStat.principal + principal,
+        "total": LoanStat.total + total,
+        "interest": LoanStat.interest + interest,
+    }
+    if row.update(values, synchronize_session=False):
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(
+                insert(LoanStat.__table__).values(
+                    loan_state=loan_state,
+                    tenure_bucket=bucket,
+                    interest_rate=interest_rate,
+                    start_month=month,
+                    shard=shard,
+                    loan_count=count,
+                    principal=principal,
+                    total=total,
+                    interest=interest,
+                )
+            )
+    except IntegrityError:
+        # Another transaction created it first.
+        row.update(values, synchronize_session=False)
+
+
+def refresh_loan_stats():
+    """ Recompute loan_stats from the loans table. """
+
+    bucket = _tenure_bucket_sql(Loan.tenure)
+    month = _start_month_sql(Loan.start_date)
+    grouped = select(
+        [
+            Loan.loan_state,
+            bucket,
+            Loan.interest_rate,
+            month,
+            literal(0),
+            func.count(),
+            func.sum(Loan.principal),
+            func.sum(Loan.total),
+            func.sum(Loan.interest),
+        ]
+    ).group_by(Loan.loan_state, bucket, Loan.interest_rate, month)
+
+    db.session.query(LoanStat).delete(synchronize_session=False)
+    db.session.execute(
+        insert(LoanStat.__table__).from_select(
+            [
+                "loan_state",
+                "tenure_bucket",
+                "interest_rate",
+                "start_month",
+                "shard",
+                "loan_count",
+                "principal",
+                "total",
+                "interest",
+            ],
+            grouped,
+        )
+    )
+    db.session.commit()
+
+
+def _rows(dimension, result):
+    rows = [
+        {
+            dimension: float(key) if dimension == "interest_rate" else key,
+            "count": count,
+            "principal": round(principal or 0, 2),
+            "total": round(total or 0, 2),
+            "interest": round(interest or 0, 2),
+        }
+        for key, count, principal, total, interest in result
+        if count
+    ]
+    if dimension == "tenure_bucket":
+        order = [label for bound, label in TENURE_BUCKETS]
+        rows.sort(key=lambda row: order.index(row["tenure_bucket"]))
+    return rows
+
+
+def live_stats():
+    """ Totals by state, tenure bucket, interest rate and start month,
+        aggregated straight from the loans table. """
+
+    columns = {
+        "loan_state": Loan.loan_state,
+        "tenure_bucket": _tenure_bucket_sql(Loan.tenure),
+        "interest_rate": Loan.interest_rate,
+        "start_month": _start_month_sql(Loan.start_date),
+    }
+    stats = {}
+    for name, dimension in DIMENSIONS.items():
+        column = columns[dimension]
+        result = (
+            db.session.query(
+                column,
+                func.count(),
+                func.sum(Loan.principal),
+                func.sum(Loan.total),
+                func.sum(Loan.interest),
+            )
+            .group_by(column)
+            .order_by(column)
+        )
+        stats[name] = _rows(dimension, result)
+    return stats
+
+
+def materialized_stats():
+    """ The same totals as live_stats, rolled up from loan_stats and its
+        shards. """
+
+    stats = {}
+    for name, dimension in DIMENSIONS.items():
+        column = getattr(LoanStat, dimension)
+        result = (
+            db.session.query(
+                column,
+                func.sum(LoanStat.loan_count),
+                func.sum(LoanStat.principal),
+                func.sum(LoanStat.total),
+                func.sum(LoanStat.interest),
+            )
+            .group_by(column)
+            .order_by(column)
+        )
+        stats[name] = _rows(dimension, result)
+    return stats
+
+
+def approved_loan_chunks(chunk_size):
+    """ Yield the APPROVED loans as dicts of column arrays of up to
+        'chunk_size' loans, paging through them by ID. """
+
+    after = 0
+    while True:
+        rows = (
+            db.session.query(
+                Loan.id, Loan.principal, Loan.interest_rate, Loan.tenure, Loan.emi, Loan.start_date
+            )
+            .filter(Loan.loan_state == "APPROVED", Loan.id > after)
+            .order_by(Loan.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            return
+        after = rows[-1][0]
+
+        ids, principal, interest_rate, tenure, emi, start_date = zip(*rows)
+        yield {
+            "principal": np.array(principal, dtype=float),
+            "interest_rate": np.array(interest_rate, dtype=float),
+            "tenure": np.array(tenure, dtype=int),
+            "emi": np.array(emi, dtype=float),
+            "start_month": np.array([month_index(date) for date in start_date], dtype=int),
+        }
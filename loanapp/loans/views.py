@@ -1,30 +1,45 @@
-from flask import Blueprint, request, jsonify, make_response, redirect
+from flask import Blueprint, request, jsonify, make_response, redirect, json
+from flask import Response, stream_with_context
 from loanapp.loans.models import Loan, Application
 from loanapp.users.models import User
 from loanapp.users.views import token_required
+from loanapp.users.summary import update_summary, update_summaries
+from loanapp.loans.bulk import import_applications
+from loanapp.loans.stats import (
+    approved_loan_chunks,
+    loan_facts,
+    record_loan_changes,
+    live_stats,
+    materialized_stats,
+)
 from loanapp.loanapplib.gir import get_interest_rate
-from loanapp.loanapplib.emi import calculate_emi
-from loanapp import db
-from datetime import datetime
+from loanapp.loanapplib.emi import loan_quote, calculate_emi_grid, calculate_emi_batch
+from loanapp.loanapplib.amortization import amortization_schedule
+from loanapp.loanapplib.projection import month_index, project_cashflows
+from loanapp import db, app
+from loanapp.database import read_only
+from loanapp.table_versions import conditional
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+import numpy as np
+import uuid
 
 
 loans_blp = Blueprint("loans", __name__, url_prefix="/loans")
 
 @loans_blp.route("/get-interest-rates", methods=["GET"])
 def get_interest_rates():
-    """ Get interest rate for the tenure selected."""
+    """ Get interest rate for the tenure selected and, optionally,
+        the loan amount. """
 
     try:
         tenure = int(request.get_json()["tenure"])
+        amount = request.get_json().get("amount")
+        amount = int(amount) if amount is not None else None
     except:
         return jsonify({"message": "Input is 'tenure' in months"}), 400
 
-    if tenure <= 5:
-        return jsonify({"interest_rate": 10}), 200
-    elif tenure > 5 and tenure <= 24:
-        return jsonify({"interest_rate": 12}), 200
-    else:
-        return jsonify({"interest_rate": 15}), 200
+    return jsonify({"interest_rate": get_interest_rate(tenure, amount)}), 200
 
 
 @loans_blp.route("/get-loan-info", methods=["GET"])
@@ -38,10 +53,7 @@ def get_loan_info():
     except:
         return jsonify({"message": "Input is 'amount' and 'tenure'"}), 400
 
-    interest_rate = get_interest_rate(tenure)
-    emi = calculate_emi(principal, interest_rate, tenure)
-    total = round(emi * tenure, 2)
-    interest = round(total - principal, 2)
+    interest_rate, emi, total, interest = loan_quote(principal, tenure)
 
     output = {
         "principal": principal,
@@ -55,36 +67,210 @@ def get_loan_info():
     return jsonify({"loan_info": output})
 
 
+@loans_blp.route("/get-loan-grid", methods=["GET"])
+def get_loan_grid():
+    """ Quote every combination of the given loan amounts and tenures.
+        Rows of the returned matrices follow 'amounts', columns follow
+        'tenures'. """
+
+    try:
+        amounts = [int(amount) for amount in request.get_json()["amounts"]]
+        tenures = [int(tenure) for tenure in request.get_json()["tenures"]]
+    except:
+        return jsonify({"message": "Input is 'amounts' and 'tenures'"}), 400
+
+    if not amounts or not tenures or min(tenures) < 1:
+        return jsonify({"message": "Input is 'amounts' and 'tenures'"}), 400
+
+    if len(amounts) * len(tenures) > app.config["LOAN_GRID_MAX_CELLS"]:
+        message = "At most " + str(app.config["LOAN_GRID_MAX_CELLS"]) + " quotes per request."
+        return jsonify({"message": message}), 400
+
+    grid = calculate_emi_grid(amounts, tenures)
+
+    output = {
+        "amounts": amounts,
+        "tenures": tenures,
+        "interest_rate": np.broadcast_to(grid["interest_rate"], grid["emi"].shape).tolist(),
+        "emi": grid["emi"].tolist(),
+        "total": grid["total"].tolist(),
+        "interest": grid["interest"].tolist(),
+    }
+
+    return jsonify({"loan_grid": output})
+
+
+LOAN_COLUMNS = (
+    Loan.id,
+    Loan.user_id,
+    Loan.principal,
+    Loan.tenure,
+    Loan.interest,
+    Loan.interest_rate,
+    Loan.emi,
+    Loan.total,
+    Loan.loan_state,
+    Loan.request_date,
+    Loan.start_date,
+    Loan.version,
+)
+
+# Loans are only ever changed with conditional UPDATEs that check and bump
+# Loan.version, so two admins or agents acting on the same loan cannot both
+# succeed.
+LOAN_CONFLICT = {"message": "Loan was changed by someone else, try again."}
+
+
+def loan_to_dict(loan):
+    """ JSON representation of a Loan or of a row of LOAN_COLUMNS. """
+
+    loan_data = {}
+    loan_data["id"] = loan.id
+    loan_data["user_id"] = loan.user_id
+    loan_data["principal"] = loan.principal
+    loan_data["tenure"] = loan.tenure
+    loan_data["interest"] = loan.interest
+    loan_data["interest_rate"] = loan.interest_rate
+    loan_data["emi"] = loan.emi
+    loan_data["total"] = loan.total
+    loan_data["loan_state"] = loan.loan_state
+    loan_data["request_date"] = loan.request_date
+    loan_data["start_date"] = loan.start_date
+    loan_data["version"] = loan.version
+    return loan_data
+
+
+def stream_json_list(key, rows, serialize):
+    """ Stream {key: [...]} without holding the whole list in memory. Rows
+        are encoded and sent in chunks of STREAM_CHUNK_SIZE. """
+
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+
+    def generate():
+        yield '{"' + key + '": ['
+        chunk = []
+        separator = ""
+        for row in rows:
+            chunk.append(separator + json.dumps(serialize(row)))
+            separator = ", "
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk) + "]}\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
 @loans_blp.route("", methods=["GET"])
+@read_only
 @token_required
+@conditional("loans")
 def get_all_loans(current_user):
-    """ View all loans - NEW, APPROVED, REJECTED. """
+    """ View all loans - NEW, APPROVED, REJECTED. Can be filtered by
+        'loan_state' and (admins and agents only) 'user_id'. Pass 'limit'
+        and then 'after' (the 'next_after' of the previous page) to page
+        through the loans by ID; without 'limit' all loans are streamed. """
 
-    if not current_user.agent or not current_user.admin:
-        loans = Loan.query.filter_by(user_id=current_user.id)
-        if not loans:
-            return jsonify({"loans": []})
-    else:
-        loans = Loan.query.all()
+    try:
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+        after = int(request.args.get("after", 0))
+    except ValueError:
+        return jsonify({"message": "'limit' and 'after' must be integers."}), 400
+
+    loans = Loan.query.with_entities(*LOAN_COLUMNS).order_by(Loan.id)
+
+    if not (current_user.agent or current_user.admin):
+        loans = loans.filter(Loan.user_id == current_user.id)
+    elif request.args.get("user_id"):
+        loans = loans.filter(Loan.user_id == request.args["user_id"])
 
-    output = []
+    if request.args.get("loan_state"):
+        loans = loans.filter(Loan.loan_state == request.args["loan_state"])
 
-    for loan in loans:
-        loan_data = {}
-        loan_data["id"] = loan.id
-        loan_data["user_id"] = loan.user_id
-        loan_data["principal"] = loan.principal
-        loan_data["tenure"] = loan.tenure
-        loan_data["interest"] = loan.interest
-        loan_data["interest_rate"] = loan.interest_rate
-        loan_data["emi"] = loan.emi
-        loan_data["total"] = loan.total
-        loan_data["loan_state"] = loan.loan_state
-        loan_data["request_date"] = loan.request_date
-        loan_data["start_date"] = loan.start_date
-        output.append(loan_data)
+    if after:
+        loans = loans.filter(Loan.id > after)
 
-    return jsonify({"loans": output})
+    if limit is None:
+        return stream_json_list(
+            "loans", loans.yield_per(app.config["STREAM_CHUNK_SIZE"]), loan_to_dict
+        )
+
+    limit = max(1, min(limit, app.config["PAGE_SIZE_MAX"]))
+    output = [loan_to_dict(loan) for loan in loans.limit(limit)]
+    next_after = output[-1]["id"] if len(output) == limit else None
+
+    return jsonify({"loans": output, "next_after": next_after})
+
+
+@loans_blp.route("/stats", methods=["GET"])
+@token_required
+def get_loan_stats(current_user):
+    """ Loan count, principal, total and interest by state, tenure bucket,
+        interest rate and start month. Can be viewed by an admin or agent.
+        Served from the loan_stats summary table unless 'live=true' is
+        passed or LOAN_STATS_MATERIALIZED is off. """
+
+    if not (current_user.admin or current_user.agent):
+        return jsonify({"message": "Cannot perform the action."})
+
+    live = request.args.get("live", "").lower() == "true"
+    if live or not app.config["LOAN_STATS_MATERIALIZED"]:
+        return jsonify({"stats": live_stats(), "source": "live"})
+
+    return jsonify({"stats": materialized_stats(), "source": "materialized"})
+
+
+@loans_blp.route("/projection", methods=["GET"])
+@token_required
+def get_cashflow_projection(current_user):
+    """ Principal and interest expected to be collected each month on the
+        approved loans, starting with the current month. 'months' sets how
+        far ahead to look. Can be viewed by an admin only. """
+
+    if not current_user.admin:
+        return jsonify({"message": "Cannot perform the action."})
+
+    try:
+        months = int(request.args.get("months", app.config["PROJECTION_MONTHS"]))
+    except ValueError:
+        return jsonify({"message": "'months' must be an integer."}), 400
+
+    months = max(1, min(months, app.config["PROJECTION_MONTHS_MAX"]))
+    projection = project_cashflows(
+        approved_loan_chunks(app.config["PROJECTION_CHUNK_SIZE"]),
+        month_index(datetime.utcnow()),
+        months,
+        app.config["PROJECTION_WORKERS"],
+    )
+
+    return jsonify({"projection": projection})
+
+
+@loans_blp.route("/<int:loan_id>/schedule", methods=["GET"])
+@token_required
+def get_loan_schedule(current_user, loan_id):
+    """ Month by month repayment schedule of a loan, streamed as
+        newline-delimited JSON. Can be viewed by the borrower, an agent
+        or an admin. """
+
+    loan = Loan.query.get(loan_id)
+
+    if not loan:
+        return jsonify({"message": "Invalid loan ID."})
+
+    if not (current_user.agent or current_user.admin) and str(loan.user_id) != str(current_user.id):
+        return jsonify({"message": "Cannot perform the action."})
+
+    schedule = amortization_schedule(
+        loan.principal, loan.interest_rate, loan.tenure, loan.emi, loan.start_date
+    )
+
+    def generate():
+        for row in schedule:
+            yield json.dumps(row) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 @loans_blp.route("/request", methods=["POST"])
@@ -113,13 +299,13 @@ def loan_request(current_user):
     if userappl.requested:
         return jsonify({"message": "Application already requested."})
 
+    if userappl.isClaimedByOther(current_user.id):
+        return jsonify({"message": "Application claimed by another agent."})
+
     principal = userappl.amount
     tenure = userappl.tenure
 
-    interest_rate = get_interest_rate(tenure)
-    emi = calculate_emi(principal, interest_rate, tenure)
-    total = round(emi * tenure, 2)
-    interest = round(total - principal, 2)
+    interest_rate, emi, total, interest = loan_quote(principal, tenure)
 
     new_loan_request = Loan(
         principal=principal,
@@ -134,16 +320,121 @@ def loan_request(current_user):
     userappl.requested = True
 
     db.session.add(new_loan_request)
+    update_summary(
+        userappl.user_id, pending_applications=-1, new_loans=1, requested_principal=principal
+    )
+    record_loan_changes(added=[loan_facts(new_loan_request)])
     db.session.commit()
 
     return jsonify({"message": "New loan requested."})
 
 
+@loans_blp.route("/request/batch", methods=["POST"])
+@token_required
+def loan_request_batch(current_user):
+    """ Request loans for many applications at once. Can be done by an
+        agent only. Input is a list of Application ID and User ID pairs;
+        the result has a message for each of them. All loans are created
+        in a single transaction. """
+
+    if not current_user.agent:
+        return jsonify({"message": "Cannot perform the action."})
+
+    try:
+        items = [
+            (int(item["application_id"]), item["user_id"])
+            for item in request.get_json()["applications"]
+        ]
+    except:
+        return jsonify({"message": "Invalid input."}), 400
+
+    if len(items) > app.config["PAGE_SIZE_MAX"]:
+        message = "At most " + str(app.config["PAGE_SIZE_MAX"]) + " applications per request."
+        return jsonify({"message": message}), 400
+
+    applications = {
+        application.id: application
+        for application in Application.query.filter(
+            Application.id.in_([application_id for application_id, user_id in items])
+        )
+    }
+
+    results = []
+    accepted = []
+    seen = set()
+    for application_id, user_id in items:
+        userappl = applications.get(application_id)
+        if not userappl or str(userappl.user_id) != str(user_id):
+            message = "Invalid application."
+        elif application_id in seen or userappl.requested:
+            message = "Application already requested."
+        elif userappl.isClaimedByOther(current_user.id):
+            message = "Application claimed by another agent."
+        else:
+            message = "New loan requested."
+            accepted.append(userappl)
+            seen.add(application_id)
+        results.append({"application_id": application_id, "user_id": user_id, "message": message})
+
+    if accepted:
+        accepted_ids = [userappl.id for userappl in accepted]
+        updated = Application.query.filter(
+            Application.id.in_(accepted_ids), Application.requested == False
+        ).update({"requested": True}, synchronize_session=False)
+        if updated != len(accepted_ids):
+            db.session.rollback()
+            return jsonify({"message": "Applications were requested concurrently, try again."}), 409
+
+        quotes = calculate_emi_batch(
+            [userappl.amount for userappl in accepted],
+            [userappl.tenure for userappl in accepted],
+        )
+        new_loans = [
+            {
+                "principal": userappl.amount,
+                "tenure": userappl.tenure,
+                "interest": interest,
+                "interest_rate": interest_rate,
+                "emi": emi,
+                "total": total,
+                "user_id": userappl.user_id,
+                "loan_state": "NEW",
+            }
+            for userappl, interest_rate, emi, total, interest in zip(
+                accepted,
+                quotes["interest_rate"].tolist(),
+                quotes["emi"].tolist(),
+                quotes["total"].tolist(),
+                quotes["interest"].tolist(),
+            )
+        ]
+        db.session.bulk_insert_mappings(Loan, new_loans)
+        record_loan_changes(
+            added=[loan_facts(new_loan) for new_loan in new_loans]
+        )
+
+        deltas_by_user = {}
+        for userappl in accepted:
+            deltas = deltas_by_user.setdefault(
+                int(userappl.user_id),
+                {"pending_applications": 0, "new_loans": 0, "requested_principal": 0},
+            )
+            deltas["pending_applications"] -= 1
+            deltas["new_loans"] += 1
+            deltas["requested_principal"] += userappl.amount
+        update_summaries(deltas_by_user)
+
+        db.session.commit()
+
+    return jsonify({"results": results})
+
+
 @loans_blp.route("/approve", methods=["PUT"])
 @token_required
 def approve_loan(current_user):
     """ Approve a loan request. Can be done by an admin only.
-        Input is the Loan ID and User ID. """
+        Input is the Loan ID and User ID, and optionally the version of
+        the loan that was reviewed. """
 
     if not current_user.admin:
         return jsonify({"message": "Cannot perform the action."})
@@ -159,11 +450,39 @@ def approve_loan(current_user):
     if not loan:
         return jsonify({"message": "Invalid loan ID."})
 
-    if loan.loan_state == "NEW":
-        loan.loan_state = "APPROVED"
-        loan.start_date = datetime.utcnow()
+    if request.get_json().get("version", loan.version) != loan.version:
+        return jsonify(LOAN_CONFLICT), 409
 
+    if loan.loan_state == "NEW":
+        start_date = datetime.utcnow()
+        approved = Loan.query.filter_by(
+            id=loan.id, loan_state="NEW", version=loan.version
+        ).update(
+            {
+                "loan_state": "APPROVED",
+                "start_date": start_date,
+                "version": Loan.version + 1,
+            },
+            synchronize_session=False,
+        )
+
+        if not approved:
+            db.session.rollback()
+            return jsonify(LOAN_CONFLICT), 409
+
+        update_summary(
+            loan.user_id,
+            new_loans=-1,
+            approved_loans=1,
+            requested_principal=-loan.principal,
+            outstanding_principal=loan.principal,
+        )
+        record_loan_changes(
+            removed=[loan_facts(loan)],
+            added=[loan_facts(loan, loan_state="APPROVED", start_date=start_date)],
+        )
         db.session.commit()
+
         message = "Loan " + str(loan.id) + " approved."
 
         return jsonify({"message": message})
@@ -174,6 +493,95 @@ def approve_loan(current_user):
     return jsonify({"message": "Cannot approve loan."})
 
 
+@loans_blp.route("/approve/batch", methods=["PUT"])
+@token_required
+def approve_loans_batch(current_user):
+    """ Approve many loan requests with a single UPDATE. Can be done by an
+        admin only. Input is a list of Loan IDs; the result tells which of
+        them were approved, which were already approved and which could
+        not be approved. """
+
+    if not current_user.admin:
+        return jsonify({"message": "Cannot perform the action."})
+
+    try:
+        loan_ids = [int(loan_id) for loan_id in request.get_json()["loan_ids"]]
+    except:
+        return jsonify({"message": "Invalid input."}), 400
+
+    if len(loan_ids) > app.config["PAGE_SIZE_MAX"]:
+        message = "At most " + str(app.config["PAGE_SIZE_MAX"]) + " loans per request."
+        return jsonify({"message": message}), 400
+
+    # Lock the loans that are still NEW and approve exactly those, so the
+    # result and the summary and stats deltas do not depend on reading the
+    # start date back. Databases without row locks (SQLite) can lose a row
+    # to a concurrent approval between the SELECT and the UPDATE; the
+    # UPDATE then changes fewer rows than were selected and the batch is
+    # tried again.
+    start_date = datetime.utcnow()
+    for attempt in range(app.config["APPROVE_BATCH_ATTEMPTS"]):
+        approved_ids = [
+            loan_id
+            for (loan_id,) in db.session.query(Loan.id)
+            .filter(Loan.id.in_(loan_ids), Loan.loan_state == "NEW")
+            .with_for_update()
+        ]
+        if not approved_ids:
+            break
+        updated = Loan.query.filter(Loan.id.in_(approved_ids), Loan.loan_state == "NEW").update(
+            {"loan_state": "APPROVED", "start_date": start_date, "version": Loan.version + 1},
+            synchronize_session=False,
+        )
+        if updated == len(approved_ids):
+            break
+        db.session.rollback()
+    else:
+        return jsonify({"message": "Loans are being changed, try again."}), 409
+
+    if approved_ids:
+        approved_loans = (
+            db.session.query(*LOAN_COLUMNS).filter(Loan.id.in_(approved_ids)).all()
+        )
+
+        deltas_by_user = {}
+        for loan in approved_loans:
+            deltas = deltas_by_user.setdefault(
+                int(loan.user_id),
+                {"new_loans": 0, "approved_loans": 0, "requested_principal": 0, "outstanding_principal": 0},
+            )
+            deltas["new_loans"] -= 1
+            deltas["approved_loans"] += 1
+            deltas["requested_principal"] -= loan.principal
+            deltas["outstanding_principal"] += loan.principal
+        update_summaries(deltas_by_user)
+
+        record_loan_changes(
+            removed=[loan_facts(loan, loan_state="NEW", start_date=None) for loan in approved_loans],
+            added=[loan_facts(loan) for loan in approved_loans],
+        )
+
+    db.session.commit()
+
+    approved = set(approved_ids)
+    states = dict(
+        db.session.query(Loan.id, Loan.loan_state).filter(
+            Loan.id.in_(set(loan_ids) - approved)
+        )
+    )
+
+    output = {"approved": [], "already_approved": [], "invalid": []}
+    for loan_id in dict.fromkeys(loan_ids):
+        if loan_id in approved:
+            output["approved"].append(loan_id)
+        elif states.get(loan_id) == "APPROVED":
+            output["already_approved"].append(loan_id)
+        else:
+            output["invalid"].append(loan_id)
+
+    return jsonify(output)
+
+
 @loans_blp.route("/apply", methods=["POST"])
 @token_required
 def loan_request_user(current_user):
@@ -186,40 +594,202 @@ def loan_request_user(current_user):
         user_id=current_user.id, amount=data["amount"], tenure=data["tenure"]
     )
     db.session.add(new_loan)
+    update_summary(current_user.id, pending_applications=1)
     db.session.commit()
 
     return jsonify({"message": "Agent will send a loan request soon."})
 
 
+@loans_blp.route("/apply/bulk", methods=["POST"])
+@token_required
+def loan_request_user_bulk(current_user):
+    """ Create many applications at once, e.g. from a partner channel. Can
+        be done by an admin or agent. Invalid rows are reported and skipped,
+        the rest are created. """
+
+    if not (current_user.admin or current_user.agent):
+        return jsonify({"message": "Cannot perform the action."})
+
+    try:
+        rows = request.get_json()["applications"]
+        if not isinstance(rows, list):
+            raise TypeError()
+    except:
+        return jsonify({"message": "Input is a list of 'applications'."}), 400
+
+    if len(rows) > app.config["IMPORT_MAX_ROWS"]:
+        message = "At most " + str(app.config["IMPORT_MAX_ROWS"]) + " applications per request."
+        return jsonify({"message": message}), 400
+
+    inserted, errors = import_applications(rows, app.config["IMPORT_CHUNK_SIZE"])
+
+    return jsonify({"inserted": inserted, "errors": errors})
+
+
+def application_to_dict(application):
+    """ JSON representation of an Application. """
+
+    application_data = {}
+    application_data["application_id"] = application.id
+    application_data["user_id"] = application.user_id
+    application_data["amount"] = application.amount
+    application_data["tenure"] = application.tenure
+    application_data["application_date"] = application.application_date
+    application_data["requested"] = application.requested
+    application_data["claimed_by"] = application.claimed_by
+    application_data["claim_expires"] = application.claim_expires
+    return application_data
+
+
+def application_cursor(application):
+    return application.application_date.isoformat() + "," + str(application.id)
+
+
+def parse_application_filters(args):
+    """ Turn the query string of an application listing into a list of
+        filter clauses. Raises ValueError on malformed input. """
+
+    filters = []
+
+    if "requested" in args:
+        if args["requested"].lower() not in ("true", "false"):
+            raise ValueError("requested")
+        filters.append(Application.requested == (args["requested"].lower() == "true"))
+    if "from" in args:
+        filters.append(Application.application_date >= datetime.fromisoformat(args["from"]))
+    if "to" in args:
+        filters.append(Application.application_date < datetime.fromisoformat(args["to"]))
+    if "min_amount" in args:
+        filters.append(Application.amount >= int(args["min_amount"]))
+    if "max_amount" in args:
+        filters.append(Application.amount <= int(args["max_amount"]))
+    if "after" in args:
+        after_date, after_id = args["after"].rsplit(",", 1)
+        after_date = datetime.fromisoformat(after_date)
+        filters.append(
+            or_(
+                Application.application_date > after_date,
+                and_(Application.application_date == after_date, Application.id > int(after_id)),
+            )
+        )
+
+    return filters
+
+
 @loans_blp.route("/view-applications", methods=["GET"])
+@read_only
 @token_required
+@conditional("applications")
 def view_applications(current_user):
-    """ View loan applications. """
+    """ View loan applications, oldest first. Can be filtered by
+        'requested', a 'from'/'to' application date range and a
+        'min_amount'/'max_amount' range. Pass 'limit' and then 'after' (the
+        'next_after' of the previous page) to page through them; without
+        'limit' all matching applications are streamed. """
+
+    if not current_user.agent:
+        return jsonify({"message": "Cannot perform this action."})
+
+    try:
+        filters = parse_application_filters(request.args)
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return jsonify({"message": "Invalid filter."}), 400
+
+    applications = Application.query.filter(*filters).order_by(
+        Application.application_date, Application.id
+    )
+
+    if limit is None:
+        return stream_json_list(
+            "applications",
+            applications.yield_per(app.config["STREAM_CHUNK_SIZE"]),
+            application_to_dict,
+        )
+
+    limit = max(1, min(limit, app.config["PAGE_SIZE_MAX"]))
+    applications = applications.limit(limit).all()
+    output = [application_to_dict(application) for application in applications]
+    next_after = application_cursor(applications[-1]) if len(applications) == limit else None
+
+    return jsonify({"applications": output, "next_after": next_after})
+
+
+@loans_blp.route("/claim", methods=["POST"])
+@token_required
+def claim_applications(current_user):
+    """ Reserve the next 'count' unrequested applications, oldest first,
+        for the calling agent. Other agents cannot request a claimed
+        application until the claim expires after CLAIM_LEASE_SECONDS. """
 
     if not current_user.agent:
         return jsonify({"message": "Cannot perform this action."})
 
-    applications = Application.query.all()
+    try:
+        count = int(request.get_json()["count"])
+    except:
+        return jsonify({"message": "Input is 'count'."}), 400
+
+    count = max(1, min(count, app.config["PAGE_SIZE_MAX"]))
+    now = datetime.utcnow()
+    claim_expires = now + timedelta(seconds=app.config["CLAIM_LEASE_SECONDS"])
+    claim_token = uuid.uuid4().hex
+    claimable = and_(
+        Application.requested == False,
+        or_(Application.claim_expires == None, Application.claim_expires <= now),
+    )
 
-    output = []
+    claimed_ids = []
+    # Claims race only on the conditional UPDATE below: rows another agent
+    # took in the meantime no longer match 'claimable' and are skipped, and
+    # the next attempt picks up the following candidates.
+    for attempt in range(app.config["CLAIM_ATTEMPTS"]):
+        candidate_ids = [
+            application_id
+            for (application_id,) in db.session.query(Application.id)
+            .filter(claimable)
+            .order_by(Application.application_date, Application.id)
+            .limit(count - len(claimed_ids))
+            .with_for_update(skip_locked=True)
+        ]
+        if not candidate_ids:
+            break
+
+        Application.query.filter(Application.id.in_(candidate_ids), claimable).update(
+            {"claimed_by": current_user.id, "claim_expires": claim_expires, "claim_token": claim_token},
+            synchronize_session=False,
+        )
+        db.session.commit()
 
-    for application in applications:
-        application_data = {}
-        application_data["application_id"] = application.id
-        application_data["user_id"] = application.user_id
-        application_data["amount"] = application.amount
-        application_data["tenure"] = application.tenure
-        application_data["application_date"] = application.application_date
-        application_data["requested"] = application.requested
-        output.append(application_data)
+        # Found again by the token of this call: a timestamp read back from
+        # the database may have lost its fractional seconds.
+        claimed_ids.extend(
+            application_id
+            for (application_id,) in db.session.query(Application.id).filter(
+                Application.id.in_(candidate_ids),
+                Application.claimed_by == current_user.id,
+                Application.claim_token == claim_token,
+            )
+        )
+        if len(claimed_ids) >= count:
+            break
+
+    applications = (
+        Application.query.filter(Application.id.in_(claimed_ids))
+        .order_by(Application.application_date, Application.id)
+        .all()
+    )
+    output = [application_to_dict(application) for application in applications]
 
-    return jsonify({"applications": output})
+    return jsonify({"applications": output, "claim_expires": claim_expires})
 
 
 @loans_blp.route("/edit/<int:loan_id>", methods=["PUT"])
 @token_required
 def edit_loan(current_user, loan_id):
-    """ Edit a loan. Input is the new loan amount and tenure.
+    """ Edit a loan. Input is the new loan amount and tenure, and
+       optionally the version of the loan that was edited.
        Loan cannot be edited if already approved. """
 
     if not current_user.agent:
@@ -236,19 +806,48 @@ def edit_loan(current_user, loan_id):
         principal = request.get_json()['amount']
         tenure = request.get_json()['tenure']
 
-        interest_rate = get_interest_rate(tenure)
-        emi = calculate_emi(principal, interest_rate, tenure)
-        total = round(emi * tenure, 2)
-        interest = round(total - principal, 2)
-
-        loan.principal = principal
-        loan.tenure = tenure
-        loan.interest = interest
-        loan.interest_rate = interest_rate
-        loan.emi = emi
-        loan.total = total
-        loan.request_date = datetime.utcnow()
-
+        if request.get_json().get("version", loan.version) != loan.version:
+            return jsonify(LOAN_CONFLICT), 409
+
+        interest_rate, emi, total, interest = loan_quote(principal, tenure)
+
+        updated = Loan.query.filter(
+            Loan.id == loan.id,
+            Loan.loan_state != "APPROVED",
+            Loan.version == loan.version,
+        ).update(
+            {
+                "principal": principal,
+                "tenure": tenure,
+                "interest": interest,
+                "interest_rate": interest_rate,
+                "emi": emi,
+                "total": total,
+                "request_date": datetime.utcnow(),
+                "version": Loan.version + 1,
+            },
+            synchronize_session=False,
+        )
+
+        if not updated:
+            db.session.rollback()
+            return jsonify(LOAN_CONFLICT), 409
+
+        if loan.loan_state == "NEW":
+            update_summary(loan.user_id, requested_principal=int(principal) - loan.principal)
+        record_loan_changes(
+            removed=[loan_facts(loan)],
+            added=[
+                loan_facts(
+                    loan,
+                    principal=principal,
+                    tenure=tenure,
+                    interest_rate=interest_rate,
+                    total=total,
+                    interest=interest,
+                )
+            ],
+        )
         db.session.commit()
 
         message = "Loan " + str(loan_id) + " updated."
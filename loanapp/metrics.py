@@ -0,0 +1,338 @@
+from bisect import bisect_left
+from threading import Lock, Thread, current_thread, local
+import json
+import os
+import time
+
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _ThreadStats:
+    """ Counters written by one thread only, so recording needs no lock. """
+
+    def __init__(self, thread):
+        self.thread = thread
+        # (endpoint, method) -> [count, seconds, bucket counts...]
+        self.latency = {}
+        # (endpoint, method, status) -> count
+        self.statuses = {}
+        # endpoint -> [queries, seconds]
+        self.queries = {}
+
+    def merge(self, other):
+        for key, values in list(other.latency.items()):
+            mine = self.latency.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                mine[i] += value
+        for key, count in list(other.statuses.items()):
+            self.statuses[key] = self.statuses.get(key, 0) + count
+        for key, values in list(other.queries.items()):
+            mine = self.queries.setdefault(key, [0, 0.0])
+            mine[0] += values[0]
+            mine[1] += values[1]
+
+    def to_json(self):
+        return {
+            "latency": [[list(key), values] for key, values in self.latency.items()],
+            "statuses": [[list(key), count] for key, count in self.statuses.items()],
+            "queries": [[key, values] for key, values in self.queries.items()],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls(None)
+        stats.latency = {tuple(key): values for key, values in data["latency"]}
+        stats.statuses = {tuple(key): count for key, count in data["statuses"]}
+        stats.queries = {key: values for key, values in data["queries"]}
+        return stats
+
+
+class Metrics:
+    """ Request latency, status and SQL counters in the Prometheus text
+        format.
+
+        Every thread records into its own _ThreadStats; a scrape adds them
+        up. Stats of threads that have exited are folded into one retired
+        total, so a server that starts a thread per request does not keep
+        one object per request.
+
+        With share(), worker processes that serve the same socket write
+        their totals to a common directory every 'interval' seconds, from a
+        thread started with their first request, and a scrape of any worker
+        adds up all of them. Counters of workers that have exited are kept,
+        their gauges are not. """
+
+    def __init__(self):
+        self._local = local()
+        self._threads = []
+        self._retired = _ThreadStats(None)
+        self._lock = Lock()
+        self._collectors = []
+        self._directory = None
+        self._interval = 1.0
+        self._writer_pid = None
+        self._write_lock = Lock()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+        app.add_url_rule("/metrics", "metrics", self.view)
+
+    def share(self, directory, interval=1.0):
+        """ Add up the metrics of every process that shares 'directory'.
+            Call in each process before it serves requests. """
+
+        self._directory = directory
+        self._interval = interval
+
+    def add_collector(self, prefix, stats, gauges=()):
+        """ Export the dict returned by 'stats()' as '<prefix>_<key>'. Keys
+            in 'gauges' are gauges, the rest are counters. """
+
+        self._collectors.append((prefix, stats, frozenset(gauges)))
+
+    def _stats(self):
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            stats = self._local.stats = _ThreadStats(current_thread())
+            with self._lock:
+                self._retire_finished()
+                self._threads.append(stats)
+        return stats
+
+    def _retire_finished(self):
+        alive = []
+        for stats in self._threads:
+            if stats.thread.is_alive():
+                alive.append(stats)
+            else:
+                self._retired.merge(stats)
+        self._threads = alive
+
+    def _before_request(self):
+        self._local.queries = 0
+        self._local.query_seconds = 0.0
+        self._local.active = True
+        g.metrics_start = time.perf_counter()
+        g.metrics_recorded = False
+
+    def _after_request(self, response):
+        self._record(response.status_code)
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs after a streamed body is finished, so queries made while
+        # streaming are counted too.
+        if "metrics_start" not in g:
+            return
+        if not g.metrics_recorded:
+            self._record(500)
+        del g.metrics_start
+        self._local.active = False
+        stats = self._stats()
+        counts = stats.queries.setdefault(request.endpoint or "unmatched", [0, 0.0])
+        counts[0] += self._local.queries
+        counts[1] += self._local.query_seconds
+        if self._directory is not None and self._writer_pid != os.getpid():
+            self._start_writer()
+
+    def _start_writer(self):
+        with self._lock:
+            # Threads do not survive a fork, so each process starts its own.
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        Thread(target=self._write_forever, name="metrics-writer", daemon=True).start()
+
+    def _write_forever(self):
+        while True:
+            try:
+                self.write()
+            except OSError:
+                pass
+            time.sleep(self._interval)
+
+    def _path(self, pid):
+        return os.path.join(self._directory, "%d.json" % pid)
+
+    def write(self):
+        """ Save this process's totals to the shared directory. """
+
+        data = {
+            "stats": self._local_snapshot().to_json(),
+            "collectors": [[prefix, stats()] for prefix, stats, gauges in self._collectors],
+        }
+        path = self._path(os.getpid())
+        with self._write_lock:
+            with open(path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(path + ".tmp", path)
+
+    def _shared(self):
+        """ (stats, collector values) saved by every process, with the
+            gauges of exited ones left out. """
+
+        found = []
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return found
+        for name in names:
+            pid, ext = os.path.splitext(name)
+            if ext != ".json" or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self._directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            try:
+                os.kill(int(pid), 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            values = {}
+            for prefix, collected in data["collectors"]:
+                gauges = next(
+                    (names for name, stats, names in self._collectors if name == prefix), frozenset()
+                )
+                values[prefix] = {
+                    key: value for key, value in collected.items() if alive or key not in gauges
+                }
+            found.append((_ThreadStats.from_json(data["stats"]), values))
+        return found
+
+    def _record(self, status):
+        elapsed = time.perf_counter() - g.metrics_start
+        g.metrics_recorded = True
+        endpoint = request.endpoint or "unmatched"
+        stats = self._stats()
+        key = (endpoint, request.method)
+        latency = stats.latency.get(key)
+        if latency is None:
+            latency = stats.latency[key] = [0, 0.0] + [0] * (len(LATENCY_BUCKETS) + 1)
+        latency[0] += 1
+        latency[1] += elapsed
+        latency[2 + bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        key = (endpoint, request.method, status)
+        stats.statuses[key] = stats.statuses.get(key, 0) + 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the statement's own context: after_cursor_execute does not
+        # run for a statement that fails, and nothing is left behind then.
+        context._metrics_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_start", None)
+        if started is not None and getattr(self._local, "active", False):
+            self._local.queries += 1
+            self._local.query_seconds += time.perf_counter() - started
+
+    def _local_snapshot(self):
+        total = _ThreadStats(None)
+        with self._lock:
+            self._retire_finished()
+            total.merge(self._retired)
+            for stats in self._threads:
+                total.merge(stats)
+        return total
+
+    def _gather(self):
+        """ Totals over all threads and collector values as
+            {prefix: {key: value}}. With share() they are added up from the
+            saved files only, this process's saved first: a worker's latest
+            requests must not show in one scrape and then be missing from
+            the next, served by another worker, or counters would go down. """
+
+        if self._directory is None:
+            values = {prefix: dict(stats()) for prefix, stats, gauges in self._collectors}
+            return self._local_snapshot(), values
+
+        self.write()
+        total = _ThreadStats(None)
+        values = {}
+        for stats, shared in self._shared():
+            total.merge(stats)
+            for prefix, collected in shared.items():
+                mine = values.setdefault(prefix, {})
+                for key, value in collected.items():
+                    mine[key] = mine.get(key, 0) + value
+        return total, values
+
+    def snapshot(self):
+        """ Totals over all threads and, with share(), all processes. """
+
+        return self._gather()[0]
+
+    def collected(self):
+        """ Collector values, added up over the processes with share(). """
+
+        return self._gather()[1]
+
+    def reset(self):
+        with self._lock:
+            self._retired = _ThreadStats(None)
+            for stats in self._threads:
+                stats.latency.clear()
+                stats.statuses.clear()
+                stats.queries.clear()
+
+    def render(self):
+        total, collected = self._gather()
+        lines = [
+            "# HELP loanapp_request_duration_seconds Time to build the response.",
+            "# TYPE loanapp_request_duration_seconds histogram",
+        ]
+        for (endpoint, method), values in sorted(total.latency.items()):
+            labels = 'endpoint="%s",method="%s"' % (endpoint, method)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), values[2:]):
+                cumulative += count
+                lines.append(
+                    'loanapp_request_duration_seconds_bucket{%s,le="%s"} %d'
+                    % (labels, bound, cumulative)
+                )
+            lines.append("loanapp_request_duration_seconds_sum{%s} %.6f" % (labels, values[1]))
+            lines.append("loanapp_request_duration_seconds_count{%s} %d" % (labels, values[0]))
+
+        lines.append("# HELP loanapp_requests_total Responses by endpoint and status.")
+        lines.append("# TYPE loanapp_requests_total counter")
+        for (endpoint, method, status), count in sorted(total.statuses.items()):
+            lines.append(
+                'loanapp_requests_total{endpoint="%s",method="%s",status="%d"} %d'
+                % (endpoint, method, status, count)
+            )
+
+        lines.append("# HELP loanapp_sql_queries_total SQL statements run by endpoint.")
+        lines.append("# TYPE loanapp_sql_queries_total counter")
+        for endpoint, (count, seconds) in sorted(total.queries.items()):
+            lines.append('loanapp_sql_queries_total{endpoint="%s"} %d' % (endpoint, count))
+        lines.append("# HELP loanapp_sql_query_seconds_total Time spent in SQL statements by endpoint.")
+        lines.append("# TYPE loanapp_sql_query_seconds_total counter")
+        for endpoint, (count, seconds) in sorted(total.queries.items()):
+            lines.append('loanapp_sql_query_seconds_total{endpoint="%s"} %.6f' % (endpoint, seconds))
+
+        for prefix, stats, gauges in self._collectors:
+            for key, value in sorted(collected.get(prefix, {}).items()):
+                name = prefix + "_" + key
+                lines.append("# TYPE %s %s" % (name, "gauge" if key in gauges else "counter"))
+                lines.append("%s %s" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def view(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+metrics = Metrics()
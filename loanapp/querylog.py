@@ -0,0 +1,136 @@
+from collections import Counter, deque
+import json
+import logging
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger("loanapp.querylog")
+
+
+class QueryLog:
+    """ Opt-in log of slow SQL statements and N+1 query patterns.
+
+        A statement slower than 'threshold' seconds is logged with its
+        query plan and the endpoint that ran it. A request that runs the
+        same statement 'n_plus_one' times or more, typically a lazy
+        relationship loaded once per row, is logged as an N+1 pattern.
+        Nothing is recorded while 'threshold' is None. The latest entries
+        are kept in memory for GET /users/slow-queries. """
+
+    def __init__(self, threshold=None, n_plus_one=10, keep=100):
+        self.threshold = threshold
+        self.n_plus_one = n_plus_one
+        self.slow = deque(maxlen=keep)
+        self.repeated = deque(maxlen=keep)
+
+    def init_app(self, app):
+        self.threshold = app.config["SLOW_QUERY_SECONDS"]
+        self.n_plus_one = app.config["N_PLUS_ONE_THRESHOLD"]
+        self.slow = deque(maxlen=app.config["SLOW_QUERY_KEEP"])
+        self.repeated = deque(maxlen=app.config["SLOW_QUERY_KEEP"])
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @property
+    def enabled(self):
+        return self.threshold is not None
+
+    def clear(self):
+        self.slow.clear()
+        self.repeated.clear()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            # On the statement's context, so a failed statement, which gets
+            # no after_cursor_execute, leaves nothing behind.
+            context._query_log_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_log_start", None)
+        if started is None or not self.enabled:
+            return
+        elapsed = time.perf_counter() - started
+
+        if has_request_context():
+            counts = g.get("query_log_counts")
+            if counts is None:
+                counts = g.query_log_counts = Counter()
+            counts[statement] += 1
+
+        if elapsed >= self.threshold:
+            entry = dict(self._where())
+            entry["seconds"] = round(elapsed, 6)
+            entry["statement"] = statement
+            entry["plan"] = None if executemany else self._explain(conn, statement, parameters)
+            self.slow.append(entry)
+            logger.warning(json.dumps(dict(entry, event="slow_query")))
+
+    def _before_request(self):
+        # The app context, and with it g, can outlive a request.
+        g.query_log_counts = Counter()
+
+    def _teardown_request(self, exc):
+        counts = g.pop("query_log_counts", None)
+        if not counts:
+            return
+        for statement, count in counts.items():
+            if count >= self.n_plus_one:
+                entry = dict(self._where())
+                entry["count"] = count
+                entry["statement"] = statement
+                self.repeated.append(entry)
+                logger.warning(json.dumps(dict(entry, event="n_plus_one")))
+
+    def _where(self):
+        if not has_request_context():
+            return {"endpoint": None, "method": None, "path": None, "time": time.time()}
+        return {
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "path": request.path,
+            "time": time.time(),
+        }
+
+    def _explain(self, conn, statement, parameters):
+        """ Query plan of a read, run on the raw DBAPI cursor so it does not
+            go through these listeners again. Other than on SQLite it runs in
+            a savepoint: a failed EXPLAIN must not abort the transaction of
+            the request, as it would on PostgreSQL. """
+
+        if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            return None
+        sqlite = conn.dialect.name == "sqlite"
+        cursor = conn.connection.cursor()
+        try:
+            if sqlite:
+                cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                rows = cursor.fetchall()
+            else:
+                cursor.execute("SAVEPOINT query_log_explain")
+                try:
+                    cursor.execute("EXPLAIN " + statement, parameters)
+                    rows = cursor.fetchall()
+                except Exception:
+                    cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+                    raise
+                finally:
+                    cursor.execute("RELEASE SAVEPOINT query_log_explain")
+        except Exception:
+            return None
+        finally:
+            cursor.close()
+        if sqlite:
+            return [row[-1] for row in rows]
+        return [" | ".join(str(column) for column in row) for row in rows]
+
+    def entries(self):
+        return {"slow_queries": list(self.slow), "n_plus_one": list(self.repeated)}
+
+
+query_log = QueryLog()
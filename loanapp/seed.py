@@ -0,0 +1,117 @@
+""" Synthetic data for load testing: users with applications and loans whose
+    amounts, tenures and states look like real traffic. The same seed and
+    anchor date always produce the same data. """
+
+from datetime import datetime, timedelta
+import random
+
+from werkzeug.security import generate_password_hash
+
+from loanapp import db
+from loanapp.loanapplib.emi import loan_quote
+from loanapp.loans.models import Application, Loan
+from loanapp.users.models import User
+
+SEED_PASSWORD = "seedpass"
+
+TENURES = [3, 6, 12, 18, 24, 36, 48, 60, 120, 180, 240, 360]
+TENURE_WEIGHTS = [4, 8, 20, 8, 16, 14, 8, 10, 5, 3, 2, 2]
+
+# What happens to an application: left pending, or turned into a loan that
+# is still NEW, got APPROVED or was REJECTED.
+OUTCOMES = ["PENDING", "NEW", "APPROVED", "REJECTED"]
+OUTCOME_WEIGHTS = [25, 15, 55, 5]
+
+HISTORY_DAYS = 5 * 365
+
+# The generated history ends at this date unless another one is given, so
+# the data does not depend on the day it is generated.
+SEED_ANCHOR = datetime(2026, 1, 1)
+
+
+def _amount(rng):
+    # Log-normal around 50k, in steps of 500.
+    amount = rng.lognormvariate(10.8, 0.9)
+    return int(min(max(amount, 1000), 5000000) // 500 * 500)
+
+
+def _generate(users, applications_per_user, seed, now):
+    rng = random.Random(seed)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    password = generate_password_hash(SEED_PASSWORD, method="sha256")
+
+    for user_id in range(first_id, first_id + users):
+        user = {"id": user_id, "name": "seed" + str(user_id), "password": password}
+        user["agent"] = rng.random() < 0.01
+        user["admin"] = False
+
+        applications = []
+        loans = []
+        for i in range(round(rng.expovariate(1 / applications_per_user)) if applications_per_user else 0):
+            amount = _amount(rng)
+            tenure = rng.choices(TENURES, TENURE_WEIGHTS)[0]
+            applied = now - timedelta(seconds=rng.uniform(0, HISTORY_DAYS * 86400))
+            outcome = rng.choices(OUTCOMES, OUTCOME_WEIGHTS)[0]
+            applications.append(
+                {
+                    "user_id": user_id,
+                    "amount": amount,
+                    "tenure": tenure,
+                    "requested": outcome != "PENDING",
+                    "application_date": applied,
+                }
+            )
+            if outcome == "PENDING":
+                continue
+
+            interest_rate, emi, total, interest = loan_quote(amount, tenure)
+            requested = applied + timedelta(seconds=rng.uniform(0, 3 * 86400))
+            started = None
+            if outcome == "APPROVED":
+                started = min(requested + timedelta(seconds=rng.uniform(0, 7 * 86400)), now)
+            loans.append(
+                {
+                    "user_id": user_id,
+                    "loan_state": outcome,
+                    "principal": amount,
+                    "tenure": tenure,
+                    "interest": interest,
+                    "interest_rate": interest_rate,
+                    "emi": emi,
+                    "total": total,
+                    "request_date": requested,
+                    "start_date": started,
+                }
+            )
+
+        yield user, applications, loans
+
+
+def seed_database(users, applications_per_user=3, seed=0, chunk_size=5000, anchor=SEED_ANCHOR):
+    """ Add 'users' users with on average 'applications_per_user'
+        applications each, dated over the HISTORY_DAYS before 'anchor' and
+        written with executemany every 'chunk_size' users. Returns the
+        number of users, applications and loans added. """
+
+    buffers = {User: [], Application: [], Loan: []}
+    counts = {User: 0, Application: 0, Loan: 0}
+
+    def flush():
+        for model, rows in buffers.items():
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+                counts[model] += len(rows)
+                rows.clear()
+        db.session.commit()
+
+    for i, (user, applications, loans) in enumerate(
+        _generate(users, applications_per_user, seed, anchor), 1
+    ):
+        buffers[User].append(user)
+        buffers[Application].extend(applications)
+        buffers[Loan].extend(loans)
+        if i % chunk_size == 0:
+            flush()
+    flush()
+
+    return counts[User], counts[Application], counts[Loan]
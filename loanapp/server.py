@@ -0,0 +1,313 @@
+""" Pre-forking HTTP server.
+
+    The master process imports the app once, opens the listening socket
+    and forks the workers, which all accept on that socket. Each worker
+    serves connections on a fixed pool of threads and gets its own
+    database connections.
+
+    Signals to the master:
+        SIGHUP           re-execute the master, loading new code and
+                         configuration, keeping the socket open; the old
+                         workers finish their requests once the new ones
+                         are up
+        SIGTERM, SIGINT  stop the workers gracefully and exit
+        SIGTTIN/SIGTTOU  add/remove a worker
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+
+logger = logging.getLogger("loanapp.server")
+
+LISTEN_FD = "LOANAPP_LISTEN_FD"
+OLD_WORKERS = "LOANAPP_OLD_WORKERS"
+# Kept across SIGHUP reloads, so the metrics carry on from where they were.
+METRICS_DIR = "LOANAPP_METRICS_DIR"
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    """ WSGI server that handles connections on a fixed thread pool. A
+        connection is only accepted once a thread is free for it, leaving
+        new connections to the other workers in the meantime. The server
+        shuts itself down after 'max_requests' connections, if set. """
+
+    # Seconds to wait for a free thread before checking for shutdown().
+    slot_wait = 0.5
+
+    def __init__(self, sock, app, threads, max_requests=0):
+        super().__init__(sock.getsockname()[0], 0, app, fd=sock.fileno())
+        # Every worker is woken up for a new connection and only one gets
+        # it; accept() must not block the others.
+        self.socket.setblocking(False)
+        self.max_requests = max_requests
+        self.handled = 0
+        self._slots = BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="request")
+        self._count_lock = Lock()
+        self._stopping = False
+
+    def _handle_request_noblock(self):
+        if not self._slots.acquire(timeout=self.slot_wait):
+            return
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            # Another worker accepted it first.
+            self._slots.release()
+            return
+        if self.verify_request(request, client_address):
+            self.process_request(request, client_address)
+        else:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+            with self._count_lock:
+                self.handled += 1
+                recycle = self.max_requests and self.handled >= self.max_requests
+            if recycle:
+                self.stop()
+
+    def stop(self):
+        """ Stop accepting connections; serve_forever() returns once the
+            requests in progress are done. """
+
+        with self._count_lock:
+            if self._stopping:
+                return
+            self._stopping = True
+        # shutdown() waits for serve_forever() to return, so it cannot run
+        # on the thread that is serving.
+        Thread(target=self.shutdown, daemon=True).start()
+
+    def serve_forever(self):
+        try:
+            super().serve_forever()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+class Master:
+
+    def __init__(self, app, db, bind, workers, threads, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, on_worker_exit=None):
+        self.app = app
+        self.db = db
+        self.bind = bind
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.on_worker_exit = on_worker_exit
+        self.socket = None
+        self.children = {}
+        self._signals = []
+
+    def listen(self):
+        """ Reuse the socket handed over by a previous master, if any. """
+
+        if os.environ.get(LISTEN_FD):
+            self.socket = socket.socket(fileno=int(os.environ.pop(LISTEN_FD)))
+        else:
+            host, port = self.bind.rsplit(":", 1)
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host, int(port)))
+            self.socket.listen(1024)
+        self.socket.set_inheritable(True)
+
+    def run(self):
+        self.listen()
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(sig, lambda signum, frame: self._signals.append(signum))
+        # Connections the master opened while loading the app must not be
+        # shared with the workers.
+        self.db.dispose()
+
+        logger.info("Listening on %s:%s", *self.socket.getsockname()[:2])
+        for i in range(self.workers):
+            self.spawn()
+        self.stop_old_workers()
+
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+                if signum == signal.SIGHUP:
+                    self.reexec()
+                elif signum == signal.SIGTTIN:
+                    self.workers += 1
+                elif signum == signal.SIGTTOU and self.workers > 1:
+                    self.workers -= 1
+            self.reap()
+            while len(self.children) < self.workers:
+                self.spawn()
+            while len(self.children) > self.workers:
+                self.kill(next(iter(self.children)), signal.SIGTERM)
+                self.reap(block=True)
+            time.sleep(0.2)
+
+    def spawn(self):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            # So the workers do not all restart at the same time.
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+
+        status = 0
+        try:
+            self.run_worker(max_requests)
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def run_worker(self, max_requests):
+        for sig in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(sig, signal.SIG_IGN)
+        # The pool was emptied before the fork; dispose again in case the
+        # master reconnected since, so every worker opens its own.
+        self.db.dispose()
+        server = PoolWSGIServer(self.socket, self.app, self.threads, max_requests)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+        logger.info("Worker %d started", os.getpid())
+        server.serve_forever()
+        if self.on_worker_exit is not None:
+            self.on_worker_exit()
+        logger.info("Worker %d stopped after %d requests", os.getpid(), server.handled)
+
+    def reap(self, block=False):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if not pid:
+                return
+            started = self.children.pop(pid, None)
+            if started is not None and os.WEXITSTATUS(status) and time.time() - started < 1:
+                # Failing on start; do not respawn in a tight loop.
+                time.sleep(1)
+            if block:
+                return
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self.children.pop(pid, None)
+
+    def stop(self):
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGKILL)
+        while self.children:
+            self.reap(block=True)
+
+    def reexec(self):
+        """ Replace the master with a fresh copy of itself. The process ID
+            stays the same, so the new master inherits the socket and the
+            running workers, and retires them after starting its own. """
+
+        logger.info("Reloading")
+        os.environ[LISTEN_FD] = str(self.socket.fileno())
+        os.environ[OLD_WORKERS] = ",".join(str(pid) for pid in self.children)
+        os.execv(sys.executable, [sys.executable, "-m", "loanapp"] + sys.argv[1:])
+
+    def stop_old_workers(self):
+        old = [int(pid) for pid in os.environ.pop(OLD_WORKERS, "").split(",") if pid]
+        for pid in old:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.graceful_timeout
+        while old and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid in old:
+                old.remove(pid)
+            elif pid:
+                # One of the new workers died; run() will replace it.
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in old:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def serve(bind=None, workers=None, threads=None, max_requests=None,
+          max_requests_jitter=None, graceful_timeout=None):
+    """ Run the app with the pre-forking server. Arguments left as None
+        come from the app's SERVER_* configuration.
+
+        Each worker keeps its own in-process state. /metrics adds up the
+        counters of all workers through files in a shared directory; the
+        login limits are split between the workers and the access token
+        cache is off, see split_between_workers(). """
+
+    from loanapp import app, db
+    from loanapp.metrics import metrics
+    from loanapp.users.views import split_between_workers
+
+    config = app.config
+    workers = workers or config["SERVER_WORKERS"] or os.cpu_count() or 1
+    if not os.environ.get(METRICS_DIR):
+        os.environ[METRICS_DIR] = tempfile.mkdtemp(prefix="loanapp-metrics-")
+    metrics.share(os.environ[METRICS_DIR])
+    split_between_workers(workers)
+    Master(
+        app,
+        db,
+        bind or config["SERVER_BIND"],
+        workers,
+        threads or config["SERVER_THREADS"],
+        config["SERVER_MAX_REQUESTS"] if max_requests is None else max_requests,
+        config["SERVER_MAX_REQUESTS_JITTER"] if max_requests_jitter is None else max_requests_jitter,
+        config["SERVER_GRACEFUL_TIMEOUT"] if graceful_timeout is None else graceful_timeout,
+        on_worker_exit=metrics.write,
+    ).run()
+    shutil.rmtree(os.environ.pop(METRICS_DIR), ignore_errors=True)
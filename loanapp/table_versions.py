@@ -0,0 +1,111 @@
+from functools import wraps
+import hashlib
+import re
+
+from flask import make_response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from loanapp import db
+
+# Tables whose changes are counted.
+TRACKED_TABLES = ("loans", "applications", "users")
+
+_WRITE = re.compile(r'\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)', re.IGNORECASE)
+
+
+class TableVersion(db.Model):
+    """ Counter bumped by every transaction that changes a table. A write
+        that is rolled back may still be counted with the connection's next
+        commit; that costs a client one full response, never a stale one. """
+
+    __tablename__ = "table_versions"
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersion %r %r>' % (self.table_name, self.version)
+
+
+@event.listens_for(TableVersion.__table__, "after_create")
+def add_tracked_tables(target, connection, **kw):
+    connection.execute(target.insert(), [{"table_name": name, "version": 0} for name in TRACKED_TABLES])
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_write(conn, cursor, statement, parameters, context, executemany):
+    """ Note on the connection which tracked tables a statement changed. """
+
+    match = _WRITE.match(statement)
+    if match and match.group(1) in TRACKED_TABLES and cursor.rowcount != 0:
+        conn.info.setdefault("changed_tables", set()).add(match.group(1))
+
+
+@event.listens_for(db.session, "after_begin")
+def remember_connection(session, transaction, connection):
+    session.info.setdefault("version_connections", set()).add(connection)
+
+
+@event.listens_for(db.session, "before_commit")
+def bump_versions(session):
+    """ Bump the counters of the tables changed on the session's
+        connections, in the transaction being committed. """
+
+    # before_commit runs ahead of the final flush; writes pending until
+    # then must be counted in this commit.
+    session.flush()
+    for connection in session.info.get("version_connections", ()):
+        changed = connection.info.pop("changed_tables", None)
+        if changed:
+            bump(connection, changed)
+
+
+@event.listens_for(db.session, "after_transaction_end")
+def forget_connections(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("version_connections", None)
+
+
+def bump(connection, tables):
+    table = TableVersion.__table__
+    for name in sorted(tables):
+        updated = connection.execute(
+            table.update().where(table.c.table_name == name).values(version=table.c.version + 1)
+        ).rowcount
+        if not updated:
+            connection.execute(table.insert().values(table_name=name, version=1))
+
+
+def table_versions(tables):
+    """ Current counters of 'tables', in order. """
+
+    found = dict(
+        db.session.query(TableVersion.table_name, TableVersion.version).filter(
+            TableVersion.table_name.in_(tables)
+        )
+    )
+    return tuple(found.get(name, 0) for name in tables)
+
+
+def conditional(*tables):
+    """ ETag/If-None-Match for a view whose response depends only on
+        'tables', the caller and the URL. An unchanged response is answered
+        with 304 before the view runs. Goes below token_required. """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            key = repr((tables, table_versions(tables), tuple(current_user), request.full_path))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(current_user, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            return response
+
+        return decorated
+
+    return decorator
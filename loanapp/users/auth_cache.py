@@ -0,0 +1,77 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+import time
+
+
+# What views get as 'current_user': just enough of a User to authorize the
+# request, so resolving a token does not need the database.
+Principal = namedtuple("Principal", ["id", "name", "admin", "agent"])
+
+
+class PrincipalCache:
+    """ LRU cache of decoded access tokens and the users they resolve to.
+
+        An entry lives for 'ttl' seconds or until the token expires,
+        whichever comes first. Views that change a user's roles or delete
+        a user must call invalidate_user(); other worker processes pick the
+        change up once their entries expire. """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._tokens_by_user = {}
+        self._lock = Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, principal, token_expires):
+        expires = min(time.time() + self.ttl, token_expires)
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (principal, expires)
+            self._tokens_by_user.setdefault(principal.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(int(user_id), ())):
+                self._remove(token)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, token):
+        principal, expires = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(principal.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[principal.id]
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+import time
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PoolBusy(Exception):
+    """ Raised when the hashing pool already has its maximum of pending
+        jobs. """
+
+
+class HashTimeout(PoolBusy):
+    """ Raised when a job does not finish within the pool's timeout. The
+        job keeps its slot until it does finish. """
+
+
+class HashingPool:
+    """ Runs password hashing and verification on a few dedicated threads.
+        At most 'max_pending' jobs may be queued or running; callers beyond
+        that are turned away straight away instead of tying up their
+        worker thread. """
+
+    def __init__(self, workers, max_pending, timeout):
+        self.timeout = timeout
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._pending = 0
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="hashing")
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password, method="sha256")
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+    def _run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusy()
+
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is given back when the job is done, not when the caller
+        # stops waiting, so timed out jobs still count towards max_pending.
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            raise HashTimeout()
+
+    def _done(self, future):
+        if not future.cancelled() and future.exception() is None:
+            with self._lock:
+                self.completed += 1
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+
+class RateLimiter:
+    """ Token buckets keyed by e.g. user name or client address. Each key
+        may spend 'burst' attempts at once and gets 'rate' attempts back per
+        second. Only the 'maxsize' most recently seen keys are tracked. """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"tracked": len(self._buckets), "rejected": self.rejected}
@@ -24,3 +24,20 @@ class User(db.Model):
 
     def __repr__(self):
         return '<User %r>' % self.id
+
+
+class UserSummary(db.Model):
+    """ Running totals of a user's applications and loans, kept up to date
+        by the loan views in the same transaction as the change itself. """
+
+    __tablename__ = "user_summaries"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    pending_applications = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    new_loans = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    approved_loans = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    requested_principal = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    outstanding_principal = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return '<UserSummary %r>' % self.user_id
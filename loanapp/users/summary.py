@@ -0,0 +1,87 @@
+from sqlalchemy import case, func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from loanapp import db
+from loanapp.loans.models import Application, Loan
+from loanapp.users.models import UserSummary
+
+SUMMARY_FIELDS = (
+    "pending_applications",
+    "new_loans",
+    "approved_loans",
+    "requested_principal",
+    "outstanding_principal",
+)
+
+
+def update_summary(user_id, **deltas):
+    """ Add 'deltas' to the user's summary in the current transaction,
+        creating the summary if the user has none yet. """
+
+    user_id = int(user_id)
+    values = {field: getattr(UserSummary, field) + delta for field, delta in deltas.items()}
+    updated = UserSummary.query.filter_by(user_id=user_id).update(
+        values, synchronize_session=False
+    )
+    if updated:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(UserSummary.__table__).values(user_id=user_id, **deltas))
+    except IntegrityError:
+        # Another transaction created it first.
+        UserSummary.query.filter_by(user_id=user_id).update(values, synchronize_session=False)
+
+
+def update_summaries(deltas_by_user):
+    """ update_summary for several users; 'deltas_by_user' maps user IDs to
+        dicts of deltas. """
+
+    for user_id, deltas in deltas_by_user.items():
+        update_summary(user_id, **deltas)
+
+
+def summary_to_dict(summary):
+    if summary is None:
+        return {field: 0 for field in SUMMARY_FIELDS}
+    return {field: getattr(summary, field) for field in SUMMARY_FIELDS}
+
+
+def rebuild_summaries():
+    """ Recompute every summary from the applications and loans tables. """
+
+    applications = (
+        select([Application.user_id, func.count().label("pending_applications")])
+        .where(Application.requested == False)
+        .group_by(Application.user_id)
+    )
+    loans = select(
+        [
+            Loan.user_id,
+            func.sum(case([(Loan.loan_state == "NEW", 1)], else_=0)).label("new_loans"),
+            func.sum(case([(Loan.loan_state == "APPROVED", 1)], else_=0)).label("approved_loans"),
+            func.sum(case([(Loan.loan_state == "NEW", Loan.principal)], else_=0)).label("requested_principal"),
+            func.sum(case([(Loan.loan_state == "APPROVED", Loan.principal)], else_=0)).label("outstanding_principal"),
+        ]
+    ).group_by(Loan.user_id)
+
+    summaries = {}
+    for row in db.session.execute(applications):
+        summaries.setdefault(int(row.user_id), {})["pending_applications"] = row.pending_applications
+    for row in db.session.execute(loans):
+        summary = summaries.setdefault(int(row.user_id), {})
+        for field in SUMMARY_FIELDS[1:]:
+            summary[field] = row[field] or 0
+
+    db.session.query(UserSummary).delete(synchronize_session=False)
+    if summaries:
+        db.session.bulk_insert_mappings(
+            UserSummary,
+            [
+                dict({field: 0 for field in SUMMARY_FIELDS}, user_id=user_id, **summary)
+                for user_id, summary in summaries.items()
+            ],
+        )
+    db.session.commit()
+    return len(summaries)
@@ -1,15 +1,72 @@
 from flask import Blueprint, request, jsonify, make_response, redirect
-from loanapp.users.models import User
+from loanapp.users.models import User, UserSummary
+from loanapp.users.summary import summary_to_dict
+from loanapp.loans.models import Application, Loan
+from loanapp.users.auth_cache import Principal, PrincipalCache
+from loanapp.users.hashing import HashingPool, PoolBusy, RateLimiter
+from loanapp.metrics import metrics
+from loanapp.querylog import query_log
 from loanapp import db, app
-from werkzeug.security import generate_password_hash, check_password_hash
+from loanapp.database import read_only
+from loanapp.table_versions import conditional
 from functools import wraps
 import jwt
 import datetime
+import os
 from flask.cli import with_appcontext
 import click
 
 users_blp = Blueprint("users", __name__, url_prefix="/users")
 
+principal_cache = PrincipalCache(
+    app.config["AUTH_CACHE_SIZE"], app.config["AUTH_CACHE_TTL"]
+)
+
+# Password hashing is CPU bound, so it gets its own small pool and login
+# attempts are rate limited per user name and per client address. A burst
+# of logins then cannot take every worker away from the rest of the API.
+hashing_pool = HashingPool(
+    app.config["HASH_POOL_WORKERS"],
+    app.config["HASH_POOL_MAX_PENDING"],
+    app.config["HASH_TIMEOUT"],
+)
+login_limits_by_name = RateLimiter(*app.config["LOGIN_RATE_PER_NAME"])
+login_limits_by_address = RateLimiter(*app.config["LOGIN_RATE_PER_ADDRESS"])
+
+metrics.add_collector("loanapp_auth_cache", principal_cache.stats, gauges=["size"])
+metrics.add_collector("loanapp_hashing_pool", hashing_pool.stats, gauges=["queue_depth"])
+metrics.add_collector("loanapp_login_limits_by_name", login_limits_by_name.stats, gauges=["tracked"])
+metrics.add_collector("loanapp_login_limits_by_address", login_limits_by_address.stats, gauges=["tracked"])
+
+
+def split_between_workers(workers):
+    """ Adjust the per-process state for 'workers' processes that serve the
+        same socket, each with its own copy. A client's logins are spread
+        over the workers, so each gets its share of the login limits. The
+        token cache is turned off: invalidate_user() only reaches the worker
+        that runs it, and the others would keep accepting a deleted or
+        demoted user until their entries expire. """
+
+    if workers <= 1:
+        return
+    for limiter in (login_limits_by_name, login_limits_by_address):
+        limiter.rate = limiter.rate / workers
+        # At least one attempt, or nobody could log in at all.
+        limiter.burst = max(1, limiter.burst / workers)
+    principal_cache.maxsize = 0
+
+
+def too_many_attempts():
+    return make_response(
+        jsonify({"message": "Too many attempts, try again later."}), 429, {"Retry-After": "1"}
+    )
+
+
+def hashing_busy():
+    return make_response(
+        jsonify({"message": "Server is busy, try again later."}), 503, {"Retry-After": "1"}
+    )
+
 
 def token_required(f):
     @wraps(f)
@@ -22,11 +79,23 @@ def token_required(f):
         if not token:
             return jsonify({"message": "Token is missing"}), 401
 
-        try:
-            data = jwt.decode(token, app.config["SECRET_KEY"])
-            current_user = User.query.get(data["user_id"])
-        except:
-            return jsonify({"message": "Token is invalid"}), 401
+        current_user = principal_cache.get(token)
+
+        if current_user is None:
+            try:
+                data = jwt.decode(token, app.config["SECRET_KEY"])
+                user = User.query.get(data["user_id"])
+            except:
+                return jsonify({"message": "Token is invalid"}), 401
+
+            if not user:
+                return jsonify({"message": "Token is invalid"}), 401
+
+            current_user = Principal(user.id, user.name, bool(user.admin), bool(user.agent))
+            # A token without an expiry is still accepted, as before the
+            # cache; it is just not cached.
+            if data.get("exp") is not None:
+                principal_cache.put(token, current_user, data["exp"])
 
         return f(current_user, *args, **kwargs)
 
@@ -39,10 +108,17 @@ def create_user():
 
     data = request.get_json()
 
+    if not login_limits_by_address.allow(request.remote_addr):
+        return too_many_attempts()
+
     if User.query.filter_by(name=data["name"]).first():
         jsonify({"message": "User with that name already exists."})
 
-    hashed_passwd = generate_password_hash(data["password"], method="sha256")
+    try:
+        hashed_passwd = hashing_pool.generate(data["password"])
+    except PoolBusy:
+        return hashing_busy()
+
     new_user = User(name=data["name"], password=hashed_passwd)
     db.session.add(new_user)
     db.session.commit()
@@ -51,7 +127,9 @@ def create_user():
 
 
 @users_blp.route("", methods=["GET"])
+@read_only
 @token_required
+@conditional("users")
 def get_all_users(current_user):
     """ Get all users. Can be done by admin and agent. """
 
@@ -73,10 +151,60 @@ def get_all_users(current_user):
     return jsonify({"message": "Cannot perform the action."})
 
 
+@users_blp.route("/auth-cache", methods=["GET"])
+@token_required
+def get_auth_cache_stats(current_user):
+    """ Hit and miss counters of the access token cache of the worker
+        process that serves the request. Can be done by admin only. """
+
+    if not current_user.admin:
+        return jsonify({"message": "Cannot perform the action."})
+
+    return jsonify({"auth_cache": principal_cache.stats(), "worker": os.getpid()})
+
+
+@users_blp.route("/login-stats", methods=["GET"])
+@token_required
+def get_login_stats(current_user):
+    """ Queue depth of the password hashing pool and rejected login
+        attempts, in the worker process that serves the request. Can be
+        done by admin only. """
+
+    if not current_user.admin:
+        return jsonify({"message": "Cannot perform the action."})
+
+    return jsonify(
+        {
+            "hashing": hashing_pool.stats(),
+            "throttled_by_name": login_limits_by_name.stats(),
+            "throttled_by_address": login_limits_by_address.stats(),
+            "worker": os.getpid(),
+        }
+    )
+
+
+@users_blp.route("/slow-queries", methods=["GET"])
+@token_required
+def get_slow_queries(current_user):
+    """ Latest slow statements with their query plans and N+1 patterns
+        seen by the slow query log of the worker process that serves the
+        request. Can be done by admin only. """
+
+    if not current_user.admin:
+        return jsonify({"message": "Cannot perform the action."})
+
+    if not query_log.enabled:
+        return jsonify({"message": "Slow query log is off."})
+
+    return jsonify(dict(query_log.entries(), worker=os.getpid()))
+
+
 @users_blp.route("/<user_id>", methods=["GET"])
+@read_only
 @token_required
 def get_this_user(current_user, user_id):
-    """ Get a particular user. Can be done by admin and agent. """
+    """ Get a particular user, with the IDs of their applications and
+        loans and a summary of them. Can be done by admin and agent. """
 
     if current_user.admin or current_user.agent:
         user = User.query.get(user_id)
@@ -87,14 +215,19 @@ def get_this_user(current_user, user_id):
         user_data = {}
         user_data["id"] = user.id
         user_data["name"] = user.name
-        application_ids = []
-        for application in user.applications:
-            application_ids.append(application.id)
-        user_data["applications"] = application_ids
-        loan_ids = []
-        for loan in user.loans:
-            loan_ids.append(loan.id)
-        user_data["loans"] = loan_ids
+        user_data["applications"] = [
+            application_id
+            for (application_id,) in db.session.query(Application.id)
+            .filter(Application.user_id == user.id)
+            .order_by(Application.id)
+        ]
+        user_data["loans"] = [
+            loan_id
+            for (loan_id,) in db.session.query(Loan.id)
+            .filter(Loan.user_id == user.id)
+            .order_by(Loan.id)
+        ]
+        user_data["summary"] = summary_to_dict(UserSummary.query.get(user.id))
 
         return jsonify({"user": user_data})
 
@@ -115,6 +248,7 @@ def promote_to_agent(current_user, user_id):
 
     user.agent = True
     db.session.commit()
+    principal_cache.invalidate_user(user.id)
 
     message = "User: " + str(user.id) + " is now an agent."
     return jsonify({"message": message})
@@ -131,8 +265,10 @@ def delete_this_user(current_user, user_id):
         if not user:
             return jsonify({"message": "User does not exist."})
 
+        UserSummary.query.filter_by(user_id=user.id).delete(synchronize_session=False)
         db.session.delete(user)
         db.session.commit()
+        principal_cache.invalidate_user(user_id)
 
         return jsonify({"message": "User Deleted."})
 
@@ -150,6 +286,11 @@ def login():
             {"WWW-Authenticate": 'Basic realm="Login required"'},
         )
 
+    if not login_limits_by_address.allow(request.remote_addr):
+        return too_many_attempts()
+    if not login_limits_by_name.allow(auth.username):
+        return too_many_attempts()
+
     user = User.query.filter_by(name=auth.username).first()
 
     if not user:
@@ -159,7 +300,12 @@ def login():
             {"WWW-Authenticate": 'Basic realm="Login required"'},
         )
 
-    if check_password_hash(user.password, auth.password):
+    try:
+        password_ok = hashing_pool.check(user.password, auth.password)
+    except PoolBusy:
+        return hashing_busy()
+
+    if password_ok:
         token = jwt.encode(
             {
                 "user_id": user.id,
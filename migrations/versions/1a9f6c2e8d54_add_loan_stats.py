@@ -0,0 +1,101 @@
+"""Add loan stats
+
+Revision ID: 1a9f6c2e8d54
+Revises: e52b8d4a0c67
+Create Date: 2026-10-18 12:08:31.662905
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a9f6c2e8d54'
+down_revision = 'e52b8d4a0c67'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # `flask init-db` may have created the table, empty, before this runs.
+    if 'loan_stats' not in inspector.get_table_names():
+        op.create_table(
+            'loan_stats',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('loan_state', sa.String(length=10), nullable=False),
+            sa.Column('tenure_bucket', sa.String(length=10), nullable=False),
+            sa.Column('interest_rate', sa.Float(), nullable=False),
+            sa.Column('start_month', sa.String(length=7), nullable=False),
+            sa.Column('shard', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('loan_count', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('principal', sa.Float(), nullable=False, server_default='0'),
+            sa.Column('total', sa.Float(), nullable=False, server_default='0'),
+            sa.Column('interest', sa.Float(), nullable=False, server_default='0'),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('loan_state', 'tenure_bucket', 'interest_rate', 'start_month', 'shard'),
+        )
+
+    if op.get_bind().execute(sa.text('SELECT COUNT(*) FROM loan_stats')).scalar():
+        return
+
+    # Fill it from the existing loans, as `flask refresh-loan-stats` does.
+    loans = sa.table(
+        'loans',
+        sa.column('loan_state', sa.String),
+        sa.column('tenure', sa.Integer),
+        sa.column('interest_rate', sa.Integer),
+        sa.column('start_date', sa.DateTime),
+        sa.column('principal', sa.Integer),
+        sa.column('total', sa.Integer),
+        sa.column('interest', sa.Integer),
+    )
+    bucket = sa.case(
+        [
+            (loans.c.tenure <= 6, '1-6'),
+            (loans.c.tenure <= 12, '7-12'),
+            (loans.c.tenure <= 24, '13-24'),
+            (loans.c.tenure <= 60, '25-60'),
+        ],
+        else_='61+',
+    )
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        month = sa.func.strftime('%Y-%m', loans.c.start_date)
+    elif dialect == 'postgresql':
+        month = sa.func.to_char(loans.c.start_date, 'YYYY-MM')
+    else:
+        month = sa.func.date_format(loans.c.start_date, '%Y-%m')
+    month = sa.func.coalesce(month, sa.literal(''))
+    grouped = sa.select(
+        [
+            loans.c.loan_state,
+            bucket,
+            loans.c.interest_rate,
+            month,
+            sa.literal(0),
+            sa.func.count(),
+            sa.func.sum(loans.c.principal),
+            sa.func.sum(loans.c.total),
+            sa.func.sum(loans.c.interest),
+        ]
+    ).where(loans.c.loan_state.isnot(None)).group_by(
+        loans.c.loan_state, bucket, loans.c.interest_rate, month
+    )
+    loan_stats = sa.table(
+        'loan_stats',
+        *[
+            sa.column(name)
+            for name in (
+                'loan_state', 'tenure_bucket', 'interest_rate', 'start_month', 'shard',
+                'loan_count', 'principal', 'total', 'interest',
+            )
+        ]
+    )
+    op.execute(loan_stats.insert().from_select([c.name for c in loan_stats.c], grouped))
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'loan_stats' in inspector.get_table_names():
+        op.drop_table('loan_stats')
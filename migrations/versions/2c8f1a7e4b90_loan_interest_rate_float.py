@@ -0,0 +1,41 @@
+"""Store fractional loan interest rates
+
+Revision ID: 2c8f1a7e4b90
+Revises: 7e4c2b9d5f18
+Create Date: 2026-10-18 21:06:52.804113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8f1a7e4b90'
+down_revision = '7e4c2b9d5f18'
+branch_labels = None
+depends_on = None
+
+
+def _interest_rate_type():
+    inspector = sa.inspect(op.get_bind())
+    if 'loans' not in inspector.get_table_names():
+        return None
+    for column in inspector.get_columns('loans'):
+        if column['name'] == 'interest_rate':
+            return column['type']
+    return None
+
+
+def upgrade():
+    if not isinstance(_interest_rate_type(), sa.Integer):
+        return
+    with op.batch_alter_table('loans') as batch_op:
+        batch_op.alter_column('interest_rate', type_=sa.Float(), existing_type=sa.Integer())
+
+
+def downgrade():
+    column_type = _interest_rate_type()
+    if column_type is None or isinstance(column_type, sa.Integer):
+        return
+    with op.batch_alter_table('loans') as batch_op:
+        batch_op.alter_column('interest_rate', type_=sa.Integer(), existing_type=sa.Float())
@@ -0,0 +1,45 @@
+"""Add work queue indexes
+
+Revision ID: 3f2a9c1d7b10
+Revises: 
+Create Date: 2026-10-18 09:12:44.318265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_applications_requested_application_date', 'applications', ['requested', 'application_date']),
+    ('ix_loans_user_id_loan_state', 'loans', ['user_id', 'loan_state']),
+]
+
+
+def _existing_indexes(table):
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def upgrade():
+    # Databases set up with `flask init-db` after this change already have
+    # the indexes, older ones get them here.
+    for name, table, columns in INDEXES:
+        existing = _existing_indexes(table)
+        if existing is not None and name not in existing:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in INDEXES:
+        existing = _existing_indexes(table)
+        if existing is not None and name in existing:
+            op.drop_index(name, table_name=table)
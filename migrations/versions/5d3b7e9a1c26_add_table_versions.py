@@ -0,0 +1,43 @@
+"""Add table versions
+
+Revision ID: 5d3b7e9a1c26
+Revises: 1a9f6c2e8d54
+Create Date: 2026-10-18 19:02:14.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d3b7e9a1c26'
+down_revision = '1a9f6c2e8d54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'table_versions' in inspector.get_table_names():
+        return
+
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name'),
+    )
+    op.bulk_insert(
+        table_versions,
+        [
+            {'table_name': 'loans', 'version': 0},
+            {'table_name': 'applications', 'version': 0},
+            {'table_name': 'users', 'version': 0},
+        ],
+    )
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'table_versions' in inspector.get_table_names():
+        op.drop_table('table_versions')
@@ -0,0 +1,39 @@
+"""Add claim token
+
+Revision ID: 7e4c2b9d5f18
+Revises: 5d3b7e9a1c26
+Create Date: 2026-10-18 20:41:05.127388
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e4c2b9d5f18'
+down_revision = '5d3b7e9a1c26'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    existing = _existing_columns('applications')
+    if existing is None or 'claim_token' in existing:
+        return
+    with op.batch_alter_table('applications') as batch_op:
+        batch_op.add_column(sa.Column('claim_token', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    existing = _existing_columns('applications')
+    if existing is None or 'claim_token' not in existing:
+        return
+    with op.batch_alter_table('applications') as batch_op:
+        batch_op.drop_column('claim_token')
@@ -0,0 +1,43 @@
+"""Add application claims
+
+Revision ID: 8c41e0a25d93
+Revises: 3f2a9c1d7b10
+Create Date: 2026-10-18 10:03:17.552940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41e0a25d93'
+down_revision = '3f2a9c1d7b10'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    existing = _existing_columns('applications')
+    if existing is None or 'claimed_by' in existing:
+        return
+    with op.batch_alter_table('applications') as batch_op:
+        batch_op.add_column(sa.Column('claimed_by', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('claim_expires', sa.DateTime(timezone=True), nullable=True))
+        batch_op.create_foreign_key('fk_applications_claimed_by_users', 'users', ['claimed_by'], ['id'])
+
+
+def downgrade():
+    existing = _existing_columns('applications')
+    if existing is None or 'claimed_by' not in existing:
+        return
+    with op.batch_alter_table('applications') as batch_op:
+        batch_op.drop_constraint('fk_applications_claimed_by_users', type_='foreignkey')
+        batch_op.drop_column('claim_expires')
+        batch_op.drop_column('claimed_by')
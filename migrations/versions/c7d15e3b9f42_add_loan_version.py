@@ -0,0 +1,39 @@
+"""Add loan version
+
+Revision ID: c7d15e3b9f42
+Revises: 8c41e0a25d93
+Create Date: 2026-10-18 10:41:05.904318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d15e3b9f42'
+down_revision = '8c41e0a25d93'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    existing = _existing_columns('loans')
+    if existing is None or 'version' in existing:
+        return
+    with op.batch_alter_table('loans') as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    existing = _existing_columns('loans')
+    if existing is None or 'version' not in existing:
+        return
+    with op.batch_alter_table('loans') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,62 @@
+"""Add user summaries
+
+Revision ID: e52b8d4a0c67
+Revises: c7d15e3b9f42
+Create Date: 2026-10-18 11:26:50.137482
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e52b8d4a0c67'
+down_revision = 'c7d15e3b9f42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # `flask init-db` may have created the table, empty, before this runs.
+    if 'user_summaries' not in inspector.get_table_names():
+        op.create_table(
+            'user_summaries',
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('pending_applications', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('new_loans', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('approved_loans', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('requested_principal', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('outstanding_principal', sa.Integer(), nullable=False, server_default='0'),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('user_id'),
+        )
+
+    if op.get_bind().execute(sa.text('SELECT COUNT(*) FROM user_summaries')).scalar():
+        return
+
+    # Backfill from the existing rows.
+    op.execute(
+        """
+        INSERT INTO user_summaries (user_id, pending_applications, new_loans, approved_loans,
+                                    requested_principal, outstanding_principal)
+        SELECT users.id,
+               (SELECT COUNT(*) FROM applications
+                 WHERE applications.user_id = users.id AND NOT applications.requested),
+               (SELECT COUNT(*) FROM loans
+                 WHERE loans.user_id = CAST(users.id AS VARCHAR(30)) AND loans.loan_state = 'NEW'),
+               (SELECT COUNT(*) FROM loans
+                 WHERE loans.user_id = CAST(users.id AS VARCHAR(30)) AND loans.loan_state = 'APPROVED'),
+               (SELECT COALESCE(SUM(principal), 0) FROM loans
+                 WHERE loans.user_id = CAST(users.id AS VARCHAR(30)) AND loans.loan_state = 'NEW'),
+               (SELECT COALESCE(SUM(principal), 0) FROM loans
+                 WHERE loans.user_id = CAST(users.id AS VARCHAR(30)) AND loans.loan_state = 'APPROVED')
+          FROM users
+        """
+    )
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'user_summaries' in inspector.get_table_names():
+        op.drop_table('user_summaries')
@@ -1,10 +1,54 @@
 from loanapp import app, db
-from loanapp.users.models import User
+from loanapp.users.models import User, UserSummary
+from loanapp.loans.models import Loan, Application, LoanStat
+from loanapp.users.summary import rebuild_summaries
+from loanapp.metrics import Metrics, metrics
+from loanapp.querylog import query_log
+from loanapp.loans.stats import refresh_loan_stats
+from loanapp.users.views import (
+    principal_cache,
+    login_limits_by_name,
+    login_limits_by_address,
+    split_between_workers,
+)
+from loanapp.loanapplib.emi import (
+    loan_quote,
+    calculate_emi,
+    calculate_emi_formula,
+    calculate_emi_grid,
+)
+from loanapp.loanapplib.annuity import annuity_factors, MAX_TENURE, RATES
+from loanapp.loanapplib.amortization import amortization_schedule
+from loanapp.loanapplib.projection import project_chunk, project_cashflows
+from loanapp.loanapplib.gir import (
+    DEFAULT_RATE_TIERS,
+    RateTable,
+    get_interest_rate,
+    rate_table,
+)
+from loanapp.server import PoolWSGIServer
+from loanapp.users.hashing import HashingPool, HashTimeout, PoolBusy
+from flask import g
 from flask_testing import TestCase
 from werkzeug.security import generate_password_hash, check_password_hash
 import unittest
 import json
 import base64
+import jwt
+import gzip
+import datetime
+import os
+import tempfile
+import shutil
+import threading
+import socket
+import sqlite3
+import urllib.request
+import signal
+import subprocess
+import sys
+import time
+from collections import Counter
 
 
 class BaseTestCase(TestCase):
@@ -14,6 +58,9 @@ class BaseTestCase(TestCase):
         return app
 
     def setUp(self):
+        principal_cache.clear()
+        login_limits_by_name.reset()
+        login_limits_by_address.reset()
         db.create_all()
 
         # Create an admin for tests.
@@ -85,10 +132,87 @@ class BaseTestCase(TestCase):
             },
         )
         self.assertEqual(
-            dict(user={"id": 2, "name": "TestUser", "applications": [], "loans": []}),
+            dict(
+                user={
+                    "id": 2,
+                    "name": "TestUser",
+                    "applications": [],
+                    "loans": [],
+                    "summary": {
+                        "pending_applications": 0,
+                        "new_loans": 0,
+                        "approved_loans": 0,
+                        "requested_principal": 0,
+                        "outstanding_principal": 0,
+                    },
+                }
+            ),
             response.json,
         )
 
+    def test_user_summary(self):
+        user_token = self.get_token("TestUser", "testuserpass")
+        agent_token = self.get_token("TestUser2", "testuserpass")
+        admin_token = self.get_token("admin", "supersecret")
+        for amount in [10000, 20000, 30000]:
+            self.client.post(
+                "/loans/apply",
+                content_type="application/json",
+                headers={"x-access-token": user_token},
+                data=json.dumps({"amount": amount, "tenure": 12}),
+            )
+        self.client.post(
+            "/loans/request",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"application_id": 1, "user_id": 2}),
+        )
+        self.client.post(
+            "/loans/request/batch",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"applications": [{"application_id": 2, "user_id": 2}]}),
+        )
+        self.client.put(
+            "/loans/edit/2",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"amount": 25000, "tenure": 12}),
+        )
+        self.client.put(
+            "/loans/approve",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"loan_id": 1, "user_id": 2}),
+        )
+
+        response = self.client.get("/users/2", headers={"x-access-token": admin_token})
+        expected = {
+            "pending_applications": 1,
+            "new_loans": 1,
+            "approved_loans": 1,
+            "requested_principal": 25000,
+            "outstanding_principal": 10000,
+        }
+        self.assertEqual([1, 2, 3], response.json["user"]["applications"])
+        self.assertEqual([1, 2], response.json["user"]["loans"])
+        self.assertEqual(expected, response.json["user"]["summary"])
+
+        self.client.put(
+            "/loans/approve/batch",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"loan_ids": [1, 2]}),
+        )
+        response = self.client.get("/users/2", headers={"x-access-token": admin_token})
+        expected.update(new_loans=0, approved_loans=2, requested_principal=0, outstanding_principal=35000)
+        self.assertEqual(expected, response.json["user"]["summary"])
+
+        # The incrementally kept summary matches one rebuilt from scratch.
+        rebuild_summaries()
+        response = self.client.get("/users/2", headers={"x-access-token": admin_token})
+        self.assertEqual(expected, response.json["user"]["summary"])
+
     def test_promote_to_agent(self):
         response = self.client.patch(
             "users/2",
@@ -96,6 +220,160 @@ class BaseTestCase(TestCase):
         )
         self.assertIn("is now an agent", response.json["message"])
 
+    def test_auth_cache(self):
+        admin_token = self.get_token("admin", "supersecret")
+        user_token = self.get_token("TestUser", "testuserpass")
+        response = self.client.get("/users/auth-cache", headers={"x-access-token": admin_token})
+        before = response.json["auth_cache"]
+
+        response = self.client.get("/users", headers={"x-access-token": user_token})
+        self.assertEqual(dict(message="Cannot perform the action."), response.json)
+        response = self.client.get("/users", headers={"x-access-token": user_token})
+        self.assertEqual(dict(message="Cannot perform the action."), response.json)
+        stats = principal_cache.stats()
+        self.assertEqual(2, stats["size"])
+        self.assertEqual(before["hits"] + 1, stats["hits"])
+        self.assertEqual(before["misses"] + 1, stats["misses"])
+
+        # Promoting the user drops their cached roles.
+        self.client.patch("users/2", headers={"x-access-token": admin_token})
+        self.assertEqual(before["invalidations"] + 1, principal_cache.stats()["invalidations"])
+        response = self.client.get("/users", headers={"x-access-token": user_token})
+        self.assertIn("users", response.json)
+
+        # So does deleting them.
+        self.client.delete("users/2", headers={"x-access-token": admin_token})
+        response = self.client.get("/users", headers={"x-access-token": user_token})
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_without_expiry(self):
+        token = jwt.encode({"user_id": 1}, app.config["SECRET_KEY"]).decode("UTF-8")
+        response = self.client.get("/users", headers={"x-access-token": token})
+        self.assertIn("users", response.json)
+        self.assertEqual(0, principal_cache.stats()["size"])
+
+    def test_login_throttle(self):
+        credentials = base64.b64encode(b"TestUser:wrongpass").decode("UTF-8")
+        statuses = [
+            self.client.get("/users/login", headers={"Authorization": "Basic " + credentials}).status_code
+            for i in range(12)
+        ]
+        self.assertEqual([401] * 10 + [429] * 2, statuses)
+
+        response = self.client.get(
+            "/users/login-stats",
+            headers={"x-access-token": self.get_token("admin", "supersecret")},
+        )
+        self.assertGreaterEqual(response.json["throttled_by_name"]["rejected"], 2)
+        self.assertEqual(0, response.json["hashing"]["queue_depth"])
+
+    def test_metrics(self):
+        metrics.reset()
+        token = self.get_token("admin", "supersecret")
+        self.client.get("/users", headers={"x-access-token": token})
+        self.client.get("/users", headers={"x-access-token": token})
+        self.client.get("/users")
+
+        # Requests served by a thread that has since exited still count.
+        worker = threading.Thread(
+            target=lambda: app.test_client().get("/users", headers={"x-access-token": token})
+        )
+        worker.start()
+        worker.join()
+
+        lines = self.client.get("/metrics").get_data(as_text=True).splitlines()
+        self.assertIn('loanapp_requests_total{endpoint="users.get_all_users",method="GET",status="200"} 3', lines)
+        self.assertIn('loanapp_requests_total{endpoint="users.get_all_users",method="GET",status="401"} 1', lines)
+        self.assertIn(
+            'loanapp_request_duration_seconds_bucket{endpoint="users.get_all_users",method="GET",le="+Inf"} 4',
+            lines,
+        )
+        queries = [line for line in lines if line.startswith('loanapp_sql_queries_total{endpoint="users.get_all_users"}')]
+        self.assertGreaterEqual(int(queries[0].split()[-1]), 3)
+        self.assertIn("loanapp_auth_cache_hits", "\n".join(lines))
+        self.assertIn("# TYPE loanapp_hashing_pool_queue_depth gauge", lines)
+
+    def test_metrics_failed_statement(self):
+        metrics.reset()
+        with app.test_request_context("/nowhere", method="GET"):
+            app.preprocess_request()
+            with self.assertRaises(Exception):
+                db.session.execute("SELECT * FROM no_such_table")
+            db.session.rollback()
+            db.session.execute("SELECT 1")
+            app.do_teardown_request()
+        count, seconds = metrics.snapshot().queries["unmatched"]
+        self.assertEqual(1, count)
+        self.assertLess(seconds, 1)
+
+    def test_slow_query_log(self):
+        token = self.get_token("admin", "supersecret")
+        response = self.client.get("/users/slow-queries", headers={"x-access-token": token})
+        self.assertEqual(dict(message="Slow query log is off."), response.json)
+
+        self.add_loans(3)
+        query_log.clear()
+        query_log.threshold = 0
+        query_log.n_plus_one = 3
+        try:
+            with self.assertLogs("loanapp.querylog", "WARNING") as logs:
+                # Left over in g, which the test client's requests share; the
+                # next request must start counting from zero.
+                g.query_log_counts = Counter({"SELECT stale": 100})
+                self.client.get("/users/2", headers={"x-access-token": token})
+
+                # Loading each user's loans with a query of its own.
+                with app.test_request_context("/users", method="GET"):
+                    for user in User.query.all():
+                        Loan.query.filter_by(user_id=user.id).all()
+                    app.do_teardown_request()
+
+            response = self.client.get("/users/slow-queries", headers={"x-access-token": token})
+        finally:
+            query_log.threshold = None
+            query_log.n_plus_one = app.config["N_PLUS_ONE_THRESHOLD"]
+
+        logged = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertTrue(all(record.levelname == "WARNING" for record in logs.records))
+        self.assertIn("slow_query", [entry["event"] for entry in logged])
+        repeated = [entry for entry in logged if entry["event"] == "n_plus_one"]
+        self.assertEqual(1, len(repeated))
+        self.assertEqual(3, repeated[0]["count"])
+
+        selects = [
+            entry
+            for entry in response.json["slow_queries"]
+            if entry["endpoint"] == "users.get_this_user" and entry["statement"].startswith("SELECT")
+        ]
+        self.assertTrue(selects)
+        self.assertTrue(all(entry["plan"] for entry in selects))
+        self.assertTrue(any("USING" in " ".join(entry["plan"]) for entry in selects))
+
+        repeated = response.json["n_plus_one"]
+        self.assertEqual(1, len(repeated))
+        self.assertEqual(3, repeated[0]["count"])
+        self.assertIn("FROM loans", repeated[0]["statement"])
+
+    def test_database_profile(self):
+        self.assertEqual("balanced", app.config["DATABASE_PROFILE"])
+        connection = db.engine.connect()
+        try:
+            self.assertEqual("wal", connection.execute("PRAGMA journal_mode").scalar())
+            # NORMAL
+            self.assertEqual(1, connection.execute("PRAGMA synchronous").scalar())
+            self.assertEqual(5000, connection.execute("PRAGMA busy_timeout").scalar())
+        finally:
+            connection.close()
+        self.assertEqual("QueuePool", type(db.engine.pool).__name__)
+
+        from sqlalchemy.engine.url import make_url
+
+        options = {"pool_size": 2}
+        db.apply_driver_hacks(app, make_url("postgresql://db/loans"), options)
+        self.assertEqual(2, options["pool_size"])
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(1800, options["pool_recycle"])
+
     def test_delete_user(self):
         response = self.client.delete(
             "users/3",
@@ -135,6 +413,151 @@ class BaseTestCase(TestCase):
         )
         self.assertIn(b"loans", response.data)
 
+    def test_get_loan_grid(self):
+        payload = json.dumps({"amounts": [10000, 25000], "tenures": [3, 12, 36]})
+        response = self.client.get(
+            "/loans/get-loan-grid", content_type="application/json", data=payload
+        )
+        self.assertEqual(response.status_code, 200)
+        grid = response.json["loan_grid"]
+        self.assertEqual([[10, 12, 15], [10, 12, 15]], grid["interest_rate"])
+        for i, amount in enumerate([10000, 25000]):
+            for j, tenure in enumerate([3, 12, 36]):
+                payload = json.dumps({"amount": amount, "tenure": tenure})
+                response = self.client.get(
+                    "/loans/get-loan-info", content_type="application/json", data=payload
+                )
+                info = response.json["loan_info"]
+                self.assertEqual(info["emi"], grid["emi"][i][j])
+                self.assertEqual(info["total"], grid["total"][i][j])
+                self.assertEqual(info["interest"], grid["interest"][i][j])
+
+    def add_loans(self, count, user_id=2, loan_state="NEW"):
+        for i in range(count):
+            loan = Loan(10000 + i, 12, 600, 12, 888.49, 10600, user_id)
+            loan.setLoanState(loan_state)
+            db.session.add(loan)
+        db.session.commit()
+
+    def test_read_replicas(self):
+        token = self.get_token("admin", "supersecret")
+        directory = tempfile.mkdtemp()
+        replicas = [os.path.join(directory, "replica%d.db" % i) for i in range(2)]
+
+        def copy_to(path):
+            db.session.remove()
+            db.engine.dispose()
+            shutil.copy(db.engine.url.database, path)
+
+        # The replicas lag behind the primary by different amounts.
+        copy_to(replicas[0])
+        self.add_loans(1)
+        copy_to(replicas[1])
+        self.add_loans(1)
+
+        def loan_count():
+            response = self.client.get("/loans?limit=10", headers={"x-access-token": token})
+            return len(response.json["loans"])
+
+        app.config["DATABASE_REPLICA_URLS"] = ["sqlite:///" + path for path in replicas]
+        app.config["REPLICA_CHECK_SECONDS"] = 0
+        try:
+            self.assertEqual({0, 1}, {loan_count(), loan_count()})
+
+            # Writes and the same client's reads right after go to the primary.
+            response = self.client.patch("users/3", headers={"x-access-token": token})
+            self.assertIn("is now an agent", response.json["message"])
+            self.assertEqual(2, loan_count())
+
+            # A replica that fails its health check is skipped.
+            self.client.cookie_jar.clear()
+            db.replicas.dispose()
+            os.remove(replicas[0])
+            self.assertEqual([1, 1, 1], [loan_count() for i in range(3)])
+        finally:
+            app.config["DATABASE_REPLICA_URLS"] = []
+            app.config["REPLICA_CHECK_SECONDS"] = 5
+            db.replicas.replicas(app)
+            shutil.rmtree(directory)
+
+    def test_etags(self):
+        admin_token = self.get_token("admin", "supersecret")
+        agent_token = self.get_token("TestUser2", "testuserpass")
+
+        def get(url, token, etag=None):
+            headers = {"x-access-token": token}
+            if etag:
+                headers["If-None-Match"] = etag
+            return self.client.get(url, headers=headers)
+
+        self.add_loans(2)
+        response = get("/loans?limit=10", admin_token)
+        etag = response.headers["ETag"]
+        self.assertEqual(2, len(response.json["loans"]))
+
+        response = get("/loans?limit=10", admin_token, etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.data)
+        self.assertEqual(etag, response.headers["ETag"])
+
+        # The tag depends on the caller and the query string too.
+        self.assertEqual(200, get("/loans?limit=10", agent_token, etag).status_code)
+        self.assertEqual(200, get("/loans?limit=5", admin_token, etag).status_code)
+
+        applications = get("/loans/view-applications?limit=10", admin_token).headers["ETag"]
+        users = get("/users", admin_token).headers["ETag"]
+
+        # Changing a loan changes the loans tag only.
+        response = self.client.put(
+            "/loans/edit/1",
+            headers={"x-access-token": agent_token},
+            content_type="application/json",
+            data=json.dumps({"amount": 20000, "tenure": 24}),
+        )
+        self.assertEqual(200, response.status_code)
+        response = get("/loans?limit=10", admin_token, etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(20000, response.json["loans"][0]["principal"])
+        self.assertEqual(304, get("/loans/view-applications?limit=10", admin_token, applications).status_code)
+        self.assertEqual(304, get("/users", admin_token, users).status_code)
+
+        # A write that matches no rows is not a change.
+        etag = get("/loans?limit=10", admin_token).headers["ETag"]
+        Loan.query.filter_by(id=12345).update({"tenure": 6})
+        db.session.commit()
+        self.assertEqual(304, get("/loans?limit=10", admin_token, etag).status_code)
+
+        self.client.patch("users/2", headers={"x-access-token": admin_token})
+        self.assertEqual(200, get("/users", admin_token, users).status_code)
+
+    def test_get_all_loans_pages(self):
+        self.add_loans(5)
+        self.add_loans(2, loan_state="APPROVED")
+        token = self.get_token("admin", "supersecret")
+
+        response = self.client.get("/loans", headers={"x-access-token": token})
+        self.assertEqual(list(range(1, 8)), [loan["id"] for loan in response.json["loans"]])
+
+        ids = []
+        after = 0
+        while after is not None:
+            response = self.client.get(
+                "/loans?loan_state=NEW&limit=2&after=" + str(after),
+                headers={"x-access-token": token},
+            )
+            ids.extend(loan["id"] for loan in response.json["loans"])
+            after = response.json["next_after"]
+        self.assertEqual([1, 2, 3, 4, 5], ids)
+
+    def test_get_all_loans_user(self):
+        self.add_loans(2)
+        self.add_loans(1, user_id=3)
+        response = self.client.get(
+            "/loans",
+            headers={"x-access-token": self.get_token("TestUser", "testuserpass")},
+        )
+        self.assertEqual([1, 2], [loan["id"] for loan in response.json["loans"]])
+
     def test_loan_request_user(self):
         payload = json.dumps({"amount": 10000, "tenure": 12})
         response = self.client.post(
@@ -164,6 +587,91 @@ class BaseTestCase(TestCase):
         )
         self.assertIn(b"applications", response.data)
 
+    def test_view_applications_pending_queue(self):
+        for amount in [5000, 10000, 15000, 20000, 25000]:
+            db.session.add(Application(2, amount, 12))
+        db.session.commit()
+        Application.query.get(2).requested = True
+        db.session.commit()
+        token = self.get_token("TestUser2", "testuserpass")
+
+        ids = []
+        after = None
+        while True:
+            url = "/loans/view-applications?requested=false&min_amount=6000&limit=2"
+            if after:
+                url += "&after=" + after
+            response = self.client.get(url, headers={"x-access-token": token})
+            ids.extend(a["application_id"] for a in response.json["applications"])
+            after = response.json["next_after"]
+            if after is None:
+                break
+        self.assertEqual([3, 4, 5], ids)
+
+        response = self.client.get(
+            "/loans/view-applications?requested=maybe", headers={"x-access-token": token}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_claim_applications(self):
+        for amount in [5000, 10000, 15000]:
+            db.session.add(Application(2, amount, 12))
+        User.query.get(1).setAgent()
+        db.session.commit()
+        admin_token = self.get_token("admin", "supersecret")
+        agent_token = self.get_token("TestUser2", "testuserpass")
+
+        response = self.client.post(
+            "/loans/claim",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"count": 2}),
+        )
+        self.assertEqual([1, 2], [a["application_id"] for a in response.json["applications"]])
+
+        response = self.client.post(
+            "/loans/claim",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"count": 5}),
+        )
+        self.assertEqual([3], [a["application_id"] for a in response.json["applications"]])
+
+        response = self.client.post(
+            "/loans/request",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"application_id": 1, "user_id": 2}),
+        )
+        self.assertEqual(dict(message="Application claimed by another agent."), response.json)
+
+        response = self.client.post(
+            "/loans/request",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"application_id": 1, "user_id": 2}),
+        )
+        self.assertEqual(dict(message="New loan requested."), response.json)
+
+    def test_fractional_interest_rate(self):
+        loan = Loan(100000, 13, 0, 13.5, 0, 0, 2)
+        db.session.add(loan)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(13.5, Loan.query.get(loan.id).interest_rate)
+
+    def test_claim_expiry_time_zone(self):
+        # PostgreSQL reads timestamp with time zone columns back aware.
+        application = Application(2, 5000, 12)
+        application.claimed_by = 1
+        utc = datetime.timezone.utc
+        application.claim_expires = datetime.datetime.now(utc) + datetime.timedelta(minutes=5)
+        self.assertTrue(application.isClaimedByOther(2))
+        application.claim_expires = (datetime.datetime.now(utc) - datetime.timedelta(minutes=5)).astimezone(
+            datetime.timezone(datetime.timedelta(hours=5))
+        )
+        self.assertFalse(application.isClaimedByOther(2))
+
     def test_loan_request(self):
         # Apply for a loan
         payload = json.dumps({"amount": 10000, "tenure": 12})
@@ -222,6 +730,51 @@ class BaseTestCase(TestCase):
         )
         self.assertEqual(dict(message="Loan 1 updated."), response.json)
 
+    def test_loan_request_batch(self):
+        for amount, tenure in [(5000, 3), (10000, 12), (15000, 36)]:
+            db.session.add(Application(2, amount, tenure))
+        db.session.commit()
+        Application.query.get(2).requested = True
+        db.session.commit()
+
+        payload = json.dumps(
+            {
+                "applications": [
+                    {"application_id": 1, "user_id": 2},
+                    {"application_id": 2, "user_id": 2},
+                    {"application_id": 3, "user_id": 3},
+                    {"application_id": 3, "user_id": 2},
+                    {"application_id": 3, "user_id": 2},
+                ]
+            }
+        )
+        response = self.client.post(
+            "/loans/request/batch",
+            content_type="application/json",
+            headers={"x-access-token": self.get_token("TestUser2", "testuserpass")},
+            data=payload,
+        )
+        self.assertEqual(
+            [
+                "New loan requested.",
+                "Application already requested.",
+                "Invalid application.",
+                "New loan requested.",
+                "Application already requested.",
+            ],
+            [result["message"] for result in response.json["results"]],
+        )
+
+        loans = Loan.query.order_by(Loan.id).all()
+        self.assertEqual([5000, 15000], [loan.principal for loan in loans])
+        for loan in loans:
+            self.assertEqual("NEW", loan.loan_state)
+            self.assertEqual(
+                (loan.interest_rate, loan.emi, loan.total, loan.interest),
+                loan_quote(loan.principal, loan.tenure),
+            )
+        self.assertTrue(all(a.requested for a in Application.query.all()))
+
     def test_approve_loan(self):
         # Apply for a loan
         payload = json.dumps({"amount": 10000, "tenure": 12})
@@ -271,6 +824,728 @@ class BaseTestCase(TestCase):
         )
         self.assertEqual(dict(message="Cannot edit loan."), response.json)
 
+    def test_approve_loans_batch(self):
+        self.add_loans(3)
+        self.add_loans(1, loan_state="APPROVED")
+        self.add_loans(1, loan_state="REJECTED")
+        payload = json.dumps({"loan_ids": [1, 2, 4, 5, 99, 2]})
+        response = self.client.put(
+            "/loans/approve/batch",
+            content_type="application/json",
+            headers={"x-access-token": self.get_token("admin", "supersecret")},
+            data=payload,
+        )
+        self.assertEqual(
+            dict(approved=[1, 2], already_approved=[4], invalid=[5, 99]), response.json
+        )
+        self.assertEqual("NEW", Loan.query.get(3).loan_state)
+        start_date = Loan.query.get(1).start_date
+        self.assertLess(abs(start_date - datetime.datetime.utcnow()), datetime.timedelta(minutes=1))
+        # The summary deltas come from the loans this call approved.
+        summary = UserSummary.query.get(2)
+        self.assertEqual(2, summary.approved_loans)
+        self.assertEqual(10000 + 10001, summary.outstanding_principal)
+
+    def test_loan_stats(self):
+        user_token = self.get_token("TestUser", "testuserpass")
+        agent_token = self.get_token("TestUser2", "testuserpass")
+        admin_token = self.get_token("admin", "supersecret")
+        for amount, tenure in [(10000, 3), (20000, 12), (30000, 12), (40000, 48)]:
+            self.client.post(
+                "/loans/apply",
+                content_type="application/json",
+                headers={"x-access-token": user_token},
+                data=json.dumps({"amount": amount, "tenure": tenure}),
+            )
+        self.client.post(
+            "/loans/request",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"application_id": 1, "user_id": 2}),
+        )
+        self.client.post(
+            "/loans/request/batch",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps(
+                {
+                    "applications": [
+                        {"application_id": 2, "user_id": 2},
+                        {"application_id": 3, "user_id": 2},
+                        {"application_id": 4, "user_id": 2},
+                    ]
+                }
+            ),
+        )
+        self.client.put(
+            "/loans/edit/4",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=json.dumps({"amount": 45000, "tenure": 72}),
+        )
+        self.client.put(
+            "/loans/approve",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"loan_id": 1, "user_id": 2}),
+        )
+        self.client.put(
+            "/loans/approve/batch",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=json.dumps({"loan_ids": [2, 4]}),
+        )
+
+        response = self.client.get("/loans/stats", headers={"x-access-token": admin_token})
+        self.assertEqual("materialized", response.json["source"])
+        stats = response.json["stats"]
+        self.assertEqual(
+            [("APPROVED", 3, 75000), ("NEW", 1, 30000)],
+            [(row["loan_state"], row["count"], row["principal"]) for row in stats["by_state"]],
+        )
+        self.assertEqual(
+            [("1-6", 1), ("7-12", 2), ("61+", 1)],
+            [(row["tenure_bucket"], row["count"]) for row in stats["by_tenure"]],
+        )
+
+        response = self.client.get("/loans/stats?live=true", headers={"x-access-token": admin_token})
+        self.assertEqual("live", response.json["source"])
+        self.assertEqual(stats, response.json["stats"])
+
+        refresh_loan_stats()
+        response = self.client.get("/loans/stats", headers={"x-access-token": admin_token})
+        self.assertEqual(stats, response.json["stats"])
+
+    def test_loan_stats_not_recorded_when_off(self):
+        app.config["LOAN_STATS_MATERIALIZED"] = False
+        try:
+            self.client.post(
+                "/loans/apply",
+                content_type="application/json",
+                headers={"x-access-token": self.get_token("TestUser", "testuserpass")},
+                data=json.dumps({"amount": 10000, "tenure": 3}),
+            )
+            self.client.post(
+                "/loans/request",
+                content_type="application/json",
+                headers={"x-access-token": self.get_token("TestUser2", "testuserpass")},
+                data=json.dumps({"application_id": 1, "user_id": 2}),
+            )
+        finally:
+            app.config["LOAN_STATS_MATERIALIZED"] = True
+        self.assertEqual(1, Loan.query.count())
+        self.assertEqual(0, LoanStat.query.count())
+
+    def test_cashflow_projection(self):
+        self.add_loans(2, loan_state="APPROVED")
+        for loan in Loan.query.all():
+            loan.start_date = datetime.datetime.utcnow()
+        db.session.commit()
+
+        response = self.client.get(
+            "/loans/projection?months=14",
+            headers={"x-access-token": self.get_token("admin", "supersecret")},
+        )
+        projection = response.json["projection"]
+        self.assertEqual(14, len(projection))
+        self.assertEqual(0, projection[0]["total"])
+        self.assertAlmostEqual(20001, sum(row["principal"] for row in projection), places=1)
+
+    def test_export(self):
+        self.add_loans(3)
+        runner = app.test_cli_runner()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            result = runner.invoke(args=["export", "users", "--output", path])
+            self.assertEqual(0, result.exit_code, result.output)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual("id,name,admin,agent", lines[0])
+            self.assertEqual(4, len(lines))
+
+            result = runner.invoke(
+                args=["export", "loans", "--format", "jsonl", "--gzip", "--output", path,
+                      "--since", "2000-01-01"]
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            with gzip.open(path, "rt") as f:
+                loans = [json.loads(line) for line in f]
+            self.assertEqual([1, 2, 3], [loan["id"] for loan in loans])
+            self.assertEqual("NEW", loans[0]["loan_state"])
+
+            result = runner.invoke(
+                args=["export", "loans", "--output", path, "--until", "2000-01-01"]
+            )
+            with open(path) as f:
+                self.assertEqual(1, len(f.read().splitlines()))
+        finally:
+            os.remove(path)
+
+    def test_bulk_apply(self):
+        payload = json.dumps(
+            {
+                "applications": [
+                    {"user_id": 2, "amount": 10000, "tenure": 12},
+                    {"user_id": 2, "amount": -5, "tenure": 12},
+                    {"user_id": 99, "amount": 10000, "tenure": 12},
+                    {"user_id": 3, "amount": "lots", "tenure": 12},
+                    {"user_id": 3, "tenure": 12},
+                    {"user_id": 3, "amount": 20000, "tenure": 24},
+                ]
+            }
+        )
+        response = self.client.post(
+            "/loans/apply/bulk",
+            content_type="application/json",
+            headers={"x-access-token": self.get_token("TestUser2", "testuserpass")},
+            data=payload,
+        )
+        self.assertEqual(2, response.json["inserted"])
+        self.assertEqual([2, 3, 4, 5], [error["row"] for error in response.json["errors"]])
+        self.assertEqual([2, 3], [a.user_id for a in Application.query.order_by(Application.id)])
+
+        response = self.client.get(
+            "/users/3", headers={"x-access-token": self.get_token("admin", "supersecret")}
+        )
+        self.assertEqual(1, response.json["user"]["summary"]["pending_applications"])
+
+    def test_import_applications(self):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("user_id,amount,tenure\n")
+                for i in range(25):
+                    f.write("2," + str(1000 * (i + 1)) + ",12\n")
+                f.write("2,,12\n")
+            result = app.test_cli_runner().invoke(
+                args=["import-applications", path, "--chunk-size", "10"]
+            )
+            self.assertIn("Imported 25 applications, 1 rows rejected.", result.output)
+            self.assertEqual(25, Application.query.count())
+        finally:
+            os.remove(path)
+
+    def test_seed(self):
+        def seeded():
+            return [
+                (loan.user_id, loan.loan_state, loan.principal, loan.tenure, loan.emi, loan.request_date)
+                for loan in Loan.query.order_by(Loan.id)
+            ]
+
+        result = app.test_cli_runner().invoke(args=["seed", "--users", "30", "--seed", "5"])
+        self.assertIn("Added 30 users", result.output)
+        first = seeded()
+        self.assertTrue(first)
+        for user_id, loan_state, principal, tenure, emi, request_date in first:
+            self.assertEqual(calculate_emi(principal, get_interest_rate(tenure), tenure), emi)
+
+        db.session.remove()
+        db.drop_all()
+        self.setUp()
+        app.test_cli_runner().invoke(args=["seed", "--users", "30", "--seed", "5"])
+        self.assertEqual(first, seeded())
+        self.assertLessEqual(
+            db.session.query(db.func.max(Application.application_date)).scalar(), datetime.datetime(2026, 1, 1)
+        )
+
+        db.session.remove()
+        db.drop_all()
+        self.setUp()
+        app.test_cli_runner().invoke(args=["seed", "--users", "30", "--seed", "5", "--anchor", "2020-06-01"])
+        self.assertLessEqual(
+            db.session.query(db.func.max(Application.application_date)).scalar(), datetime.datetime(2020, 6, 1)
+        )
+
+        response = self.client.get(
+            "/loans/stats?live=true", headers={"x-access-token": self.get_token("admin", "supersecret")}
+        )
+        live = response.json["stats"]
+        response = self.client.get(
+            "/loans/stats", headers={"x-access-token": self.get_token("admin", "supersecret")}
+        )
+        self.assertEqual(live, response.json["stats"])
+
+    def test_loan_version_conflicts(self):
+        self.add_loans(1)
+        agent_token = self.get_token("TestUser2", "testuserpass")
+        admin_token = self.get_token("admin", "supersecret")
+
+        # The agent edits the loan the admin is about to approve.
+        payload = json.dumps({"amount": 12000, "tenure": 24, "version": 1})
+        response = self.client.put(
+            "/loans/edit/1",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=payload,
+        )
+        self.assertEqual(dict(message="Loan 1 updated."), response.json)
+
+        payload = json.dumps({"loan_id": 1, "user_id": 2, "version": 1})
+        response = self.client.put(
+            "/loans/approve",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=payload,
+        )
+        self.assertEqual(response.status_code, 409)
+
+        payload = json.dumps({"loan_id": 1, "user_id": 2, "version": 2})
+        response = self.client.put(
+            "/loans/approve",
+            content_type="application/json",
+            headers={"x-access-token": admin_token},
+            data=payload,
+        )
+        self.assertEqual(dict(message="Loan 1 approved."), response.json)
+
+        # A stale edit cannot change the approved loan.
+        payload = json.dumps({"amount": 15000, "tenure": 36, "version": 3})
+        response = self.client.put(
+            "/loans/edit/1",
+            content_type="application/json",
+            headers={"x-access-token": agent_token},
+            data=payload,
+        )
+        self.assertEqual(dict(message="Cannot edit loan."), response.json)
+        db.session.expire_all()
+        self.assertEqual(12000, Loan.query.get(1).principal)
+
+    def test_loan_schedule(self):
+        payload = json.dumps({"amount": 10000, "tenure": 12})
+        self.client.post(
+            "/loans/apply",
+            content_type="application/json",
+            headers={"x-access-token": self.get_token("TestUser", "testuserpass")},
+            data=payload,
+        )
+        payload = json.dumps({"application_id": 1, "user_id": 2})
+        self.client.post(
+            "/loans/request",
+            content_type="application/json",
+            headers={"x-access-token": self.get_token("TestUser2", "testuserpass")},
+            data=payload,
+        )
+
+        response = self.client.get(
+            "/loans/1/schedule",
+            headers={"x-access-token": self.get_token("TestUser", "testuserpass")},
+        )
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(12, len(rows))
+        self.assertEqual(12, rows[-1]["month"])
+        self.assertEqual(0, rows[-1]["balance"])
+        self.assertAlmostEqual(10000, sum(row["principal"] for row in rows), places=2)
+
+
+class EMIGridTestCase(unittest.TestCase):
+
+    def test_grid_matches_scalar_quotes(self):
+        amounts = list(range(1000, 500001, 7919))
+        tenures = list(range(1, 361, 7))
+        grid = calculate_emi_grid(amounts, tenures)
+        for i, amount in enumerate(amounts):
+            for j, tenure in enumerate(tenures):
+                interest_rate, emi, total, interest = loan_quote(amount, tenure)
+                self.assertEqual(interest_rate, grid["interest_rate"][j])
+                self.assertEqual(emi, grid["emi"][i, j])
+                self.assertEqual(total, grid["total"][i, j])
+                self.assertEqual(interest, grid["interest"][i, j])
+
+
+class AnnuityTableTestCase(unittest.TestCase):
+
+    def test_table_matches_formula(self):
+        amounts = [1, 999, 10000, 123457, 2500000] + list(range(500, 200000, 3331))
+        for rate in RATES:
+            for tenure in range(1, MAX_TENURE + 1):
+                self.assertIsNotNone(annuity_factors(rate, tenure))
+                for amount in amounts:
+                    self.assertEqual(
+                        calculate_emi_formula(amount, rate, tenure),
+                        calculate_emi(amount, rate, tenure),
+                    )
+
+    def test_out_of_range_tenure_falls_back(self):
+        self.assertIsNone(annuity_factors(12, MAX_TENURE + 1))
+        self.assertIsNone(annuity_factors(11, 12))
+        self.assertEqual(
+            calculate_emi_formula(50000, 12, MAX_TENURE + 12),
+            calculate_emi(50000, 12, MAX_TENURE + 12),
+        )
+
+
+class RateTableTestCase(unittest.TestCase):
+
+    TIERS = [
+        {"max_tenure": 12, "rate": 11},
+        {"max_tenure": 12, "max_amount": 50000, "rate": 10},
+        {"max_tenure": None, "max_amount": 100000, "rate": 14},
+        {"max_tenure": None, "rate": 13.5},
+    ]
+
+    def tearDown(self):
+        rate_table.load(DEFAULT_RATE_TIERS)
+
+    def test_default_tiers(self):
+        self.assertEqual(
+            [10, 10, 12, 12, 15, 15],
+            [get_interest_rate(tenure) for tenure in [1, 5, 6, 24, 25, 360]],
+        )
+        self.assertEqual(12, get_interest_rate("12"))
+
+    def test_amount_bands(self):
+        rate_table.load(self.TIERS)
+        self.assertEqual(10, get_interest_rate(12))
+        self.assertEqual(10, get_interest_rate(12, 50000))
+        self.assertEqual(11, get_interest_rate(12, 50001))
+        self.assertEqual(14, get_interest_rate(13, 100000))
+        self.assertEqual(13.5, get_interest_rate(13, 100001))
+
+        amounts = [1000, 50000, 50001, 100000, 250000]
+        tenures = [6, 12, 13, 60]
+        grid = calculate_emi_grid(amounts, tenures)
+        for i, amount in enumerate(amounts):
+            for j, tenure in enumerate(tenures):
+                interest_rate, emi, total, interest = loan_quote(amount, tenure)
+                self.assertEqual(interest_rate, grid["interest_rate"][i, j])
+                self.assertEqual(emi, grid["emi"][i, j])
+                self.assertEqual(total, grid["total"][i, j])
+
+    def test_invalid_tiers(self):
+        with self.assertRaises(ValueError):
+            RateTable([{"max_tenure": 12, "rate": 10}])
+        with self.assertRaises(ValueError):
+            RateTable([{"max_tenure": None, "max_amount": 1000, "rate": 10}])
+
+    def test_reload_from_file(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                json.dump(DEFAULT_RATE_TIERS, f)
+            table = RateTable()
+            table.watch(path, 0)
+            self.assertEqual(12, table.lookup(12))
+
+            with open(path, "w") as f:
+                json.dump(self.TIERS, f)
+            os.utime(path, (0, 1))
+            self.assertEqual(11, table.lookup(12, 60000))
+
+            # A broken file leaves the current tiers in place.
+            with open(path, "w") as f:
+                f.write("{")
+            os.utime(path, (0, 2))
+            self.assertEqual(11, table.lookup(12, 60000))
+        finally:
+            os.remove(path)
+
+
+class ProjectionTestCase(unittest.TestCase):
+
+    def test_chunk_matches_schedule(self):
+        loans = [(10000, 10, 3), (250000, 12, 24), (1500000, 15, 360)]
+        principal, interest = project_chunk(
+            [p for p, r, t in loans],
+            [r for p, r, t in loans],
+            [t for p, r, t in loans],
+            [calculate_emi(p, r, t) for p, r, t in loans],
+            [0, 1, -2],
+            400,
+        )
+        expected_principal = [0.0] * 400
+        expected_interest = [0.0] * 400
+        for (p, r, t), first_month in zip(loans, [0, 1, -2]):
+            for row in amortization_schedule(p, r, t):
+                month = first_month + row["month"] - 1
+                if month >= 0:
+                    expected_principal[month] += row["principal"]
+                    expected_interest[month] += row["interest"]
+        # The schedule rounds every row to cents, the projection does not.
+        # Month by month they agree to a few cents; the schedule's last
+        # payment clears the rounding carried over all earlier months, which
+        # over 360 months comes to a few units.
+        last_months = {first_month + t - 1 for (p, r, t), first_month in zip(loans, [0, 1, -2])}
+        for month in range(400):
+            delta = 5 if month in last_months else 0.05
+            self.assertAlmostEqual(expected_principal[month], principal[month], delta=delta)
+            self.assertAlmostEqual(expected_interest[month], interest[month], delta=0.05)
+        self.assertAlmostEqual(sum(expected_principal), principal.sum(), delta=0.05)
+
+    def test_process_pool(self):
+        chunks = [
+            {
+                "principal": [10000 * (i + 1) for i in range(50)],
+                "interest_rate": [12] * 50,
+                "tenure": [12 + i for i in range(50)],
+                "emi": [calculate_emi(10000 * (i + 1), 12, 12 + i) for i in range(50)],
+                "start_month": [24300 + i % 7 for i in range(50)],
+            }
+        ] * 3
+        self.assertEqual(
+            project_cashflows(chunks, 24303, 60),
+            project_cashflows(chunks, 24303, 60, workers=2),
+        )
+
+
+class HashingPoolTestCase(unittest.TestCase):
+
+    def test_timeout_keeps_slot(self):
+        pool = HashingPool(workers=1, max_pending=1, timeout=0.05)
+        release = threading.Event()
+
+        with self.assertRaises(HashTimeout):
+            pool._run(release.wait, 5)
+        # The timed out job still holds the only slot.
+        with self.assertRaises(PoolBusy):
+            pool._run(lambda: None)
+        self.assertEqual(1, pool.stats()["queue_depth"])
+
+        release.set()
+        pool._executor.shutdown(wait=True)
+        stats = pool.stats()
+        self.assertEqual((0, 1, 1, 1), (stats["queue_depth"], stats["completed"], stats["rejected"], stats["timed_out"]))
+
+    def test_failures_are_not_completed(self):
+        pool = HashingPool(workers=1, max_pending=2, timeout=5)
+        with self.assertRaises(ValueError):
+            pool._run(int, "x")
+        pool._executor.shutdown(wait=True)
+        self.assertEqual(0, pool.stats()["completed"])
+        self.assertEqual(0, pool.stats()["queue_depth"])
+
+
+class MigrationTestCase(unittest.TestCase):
+    """ The container's startup path: `flask init-db` creates the tables of
+        the current models on a database that already has data, then
+        `flask db upgrade` runs the migrations. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "migrate.db")
+        self.env = dict(os.environ, FLASK_APP="loanapp", DATABASE_URL="sqlite:///" + self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def flask(self, *args):
+        subprocess.run(
+            [sys.executable, "-m", "flask"] + list(args),
+            env=self.env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def execute(self, *statements):
+        connection = sqlite3.connect(self.path)
+        try:
+            for statement in statements:
+                connection.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def query(self, statement):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(statement).fetchall()
+        finally:
+            connection.close()
+
+    def test_init_db_then_upgrade_backfills(self):
+        self.flask("init-db")
+        self.execute(
+            "INSERT INTO users (id, name, password, admin, agent) VALUES (1, 'user', 'x', 0, 0)",
+            "INSERT INTO applications (user_id, amount, tenure, requested) VALUES (1, 5000, 12, 0)",
+            "INSERT INTO loans (user_id, loan_state, principal, tenure, interest, interest_rate, emi, total, version)"
+            " VALUES ('1', 'NEW', 10000, 12, 660, 12, 888, 10660, 1)",
+            "INSERT INTO loans (user_id, loan_state, principal, tenure, interest, interest_rate, emi, total,"
+            " start_date, version) VALUES ('1', 'APPROVED', 20000, 36, 4960, 15, 693, 24960,"
+            " '2026-03-04 10:00:00', 1)",
+        )
+        self.flask("db", "upgrade")
+
+        self.assertEqual(
+            [(1, 1, 1, 1, 10000, 20000)],
+            self.query(
+                "SELECT user_id, pending_applications, new_loans, approved_loans,"
+                " requested_principal, outstanding_principal FROM user_summaries"
+            ),
+        )
+        self.assertEqual(
+            [("APPROVED", "25-60", 15.0, "2026-03", 1, 20000.0), ("NEW", "7-12", 12.0, "", 1, 10000.0)],
+            self.query(
+                "SELECT loan_state, tenure_bucket, interest_rate, start_month, loan_count, principal"
+                " FROM loan_stats ORDER BY loan_state"
+            ),
+        )
+
+
+class WorkerStateTestCase(unittest.TestCase):
+
+    def test_shared_metrics(self):
+        directory = tempfile.mkdtemp()
+        exited = subprocess.Popen([sys.executable, "-c", ""])
+        exited.wait()
+        shared = Metrics()
+        shared.add_collector("loanapp_cache", lambda: {"size": 2, "hits": 3}, gauges=["size"])
+        shared.share(directory)
+        try:
+            for pid, size, hits in [(os.getppid(), 5, 7), (exited.pid, 11, 13)]:
+                with open(os.path.join(directory, "%d.json" % pid), "w") as f:
+                    json.dump(
+                        {
+                            "stats": {
+                                "latency": [],
+                                "statuses": [[["users.get_all_users", "GET", 200], 4]],
+                                "queries": [["users.get_all_users", [8, 0.5]]],
+                            },
+                            "collectors": [["loanapp_cache", {"size": size, "hits": hits}]],
+                        },
+                        f,
+                    )
+
+            total = shared.snapshot()
+            self.assertEqual(8, total.statuses[("users.get_all_users", "GET", 200)])
+            self.assertEqual([16, 1.0], total.queries["users.get_all_users"])
+            # The gauge of the worker that exited is left out.
+            self.assertEqual({"size": 7, "hits": 23}, shared.collected()["loanapp_cache"])
+
+            shared.write()
+            self.assertTrue(os.path.exists(os.path.join(directory, "%d.json" % os.getpid())))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_split_between_workers(self):
+        saved = [(limiter.rate, limiter.burst) for limiter in (login_limits_by_name, login_limits_by_address)]
+        maxsize = principal_cache.maxsize
+        try:
+            split_between_workers(1)
+            self.assertEqual(maxsize, principal_cache.maxsize)
+
+            split_between_workers(20)
+            rate, burst = app.config["LOGIN_RATE_PER_NAME"]
+            self.assertAlmostEqual(rate / 20, login_limits_by_name.rate)
+            self.assertEqual(1, login_limits_by_name.burst)
+            rate, burst = app.config["LOGIN_RATE_PER_ADDRESS"]
+            self.assertAlmostEqual(burst / 20, login_limits_by_address.burst)
+            self.assertEqual(0, principal_cache.maxsize)
+        finally:
+            for limiter, (rate, burst) in zip((login_limits_by_name, login_limits_by_address), saved):
+                limiter.rate, limiter.burst = rate, burst
+            principal_cache.maxsize = maxsize
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def test_pool_server_recycles(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        port = listener.getsockname()[1]
+        server = PoolWSGIServer(listener, app, threads=2, max_requests=3)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        url = "http://127.0.0.1:%d/metrics" % port
+        for i in range(3):
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(200, response.status)
+
+        # The third request makes the server stop by itself.
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(3, server.handled)
+        server.server_close()
+        listener.close()
+
+    def test_pool_server_accepts_only_with_free_thread(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        server = PoolWSGIServer(listener, app, threads=1)
+        server.slot_wait = 0.05
+        # The only thread is busy.
+        server._slots.acquire()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            client = socket.create_connection(listener.getsockname(), timeout=5)
+            time.sleep(0.3)
+            # Still waiting in the backlog, so another worker could take it.
+            listener.settimeout(5)
+            accepted, address = listener.accept()
+            accepted.close()
+            client.close()
+        finally:
+            server._slots.release()
+            server.stop()
+            thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(0, server.handled)
+        server.server_close()
+        listener.close()
+
+    def test_master_serves_and_stops(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(directory, "metrics"))
+        env = dict(
+            os.environ,
+            DATABASE_URL="sqlite:///" + os.path.join(directory, "server.db"),
+            LOANAPP_METRICS_DIR=os.path.join(directory, "metrics"),
+        )
+        master = subprocess.Popen(
+            [sys.executable, "-m", "loanapp", "--bind", "127.0.0.1:%d" % port, "--workers", "2", "--threads", "2"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.time() + 20
+            while True:
+                try:
+                    with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=5) as response:
+                        self.assertEqual(200, response.status)
+                    break
+                except OSError:
+                    if time.time() > deadline or master.poll() is not None:
+                        raise
+                    time.sleep(0.1)
+
+            def scraped():
+                with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=5) as response:
+                    for line in response.read().decode().splitlines():
+                        if line.startswith('loanapp_requests_total{endpoint="metrics",method="GET",status="200"}'):
+                            return int(line.split()[-1])
+                return 0
+
+            for i in range(20):
+                scraped()
+            # Each worker saves its totals every second.
+            time.sleep(1.5)
+            counts = [scraped() for i in range(5)]
+            # Whichever worker answers, the count covers all of them.
+            self.assertGreaterEqual(counts[0], 21)
+            self.assertEqual(sorted(counts), counts)
+
+            master.send_signal(signal.SIGTERM)
+            self.assertEqual(0, master.wait(timeout=20))
+            with self.assertRaises(OSError):
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        finally:
+            if master.poll() is None:
+                master.kill()
+                master.wait()
+            shutil.rmtree(directory)
+
 
 if __name__ == "__main__":
     unittest.main()